@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+# Builds fake boxes and serves them over HTTP from a local thread.
+
+from __future__ import absolute_import
+
+import os
+import json
+import tarfile
+import threading
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+VMX = """.encoding = "UTF-8"
+config.version = "8"
+virtualHW.version = "14"
+displayName = "bench"
+guestOS = "ubuntu-64"
+memsize = "{memsize}"
+numvcpus = "{numvcpus}"
+scsi0.present = "TRUE"
+scsi0:0.present = "TRUE"
+scsi0:0.fileName = "disk.vmdk"
+"""
+
+
+def make_box(path, size, memsize=512, numvcpus=1):
+    """
+    Writes a box with a VMX and a disk of `size` bytes of incompressible
+    data (so downloads and extractions move real bytes) to path.
+    """
+    directory = os.path.dirname(path)
+    disk = os.path.join(directory, 'disk.vmdk')
+    vmx = os.path.join(directory, 'bench.vmx')
+    metadata = os.path.join(directory, 'metadata.json')
+    with open(disk, 'wb') as fp:
+        chunk = 1024 * 1024
+        while size > 0:
+            fp.write(os.urandom(min(chunk, size)))
+            size -= chunk
+    with open(vmx, 'w') as fp:
+        fp.write(VMX.format(memsize=memsize, numvcpus=numvcpus))
+    with open(metadata, 'w') as fp:
+        json.dump({'provider': 'vmware_desktop'}, fp)
+    with tarfile.open(path, 'w') as tar:
+        for filename in (metadata, vmx, disk):
+            tar.add(filename, arcname=os.path.basename(filename))
+            os.unlink(filename)
+    return path
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BoxServer(object):
+    """
+    Serves the files in a directory on a free port of 127.0.0.1.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        handler = QuietHandler
+
+        # SimpleHTTPRequestHandler serves from the current directory (the
+        # `directory` argument only exists on Python 3.7+):
+        class Handler(handler):
+            def translate_path(self, path):
+                return os.path.join(directory, os.path.basename(path.split('?', 1)[0]))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+# A stand-in for VMware's vmrun which keeps the state of its VMs (running,
+# suspended, snapshots) in a directory and simulates latency and failures.
+# It's configured by the JSON file in FAKE_VMRUN_CONFIG:
+#
+#     {
+#         "state_dir": "/tmp/fake-vmrun",
+#         "latency": {"default": 0.05, "start": 2.0},
+#         "failures": {"start": 0.1},
+#         "ip": "192.168.1.10",
+#         "tools": "running"
+#     }
+#
+# latency is in seconds and failures is the probability of each command
+# failing, both keyed by vmrun command ("default" applies to the rest).
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+
+DEFAULTS = {
+    'state_dir': None,
+    'latency': {'default': 0.0},
+    'failures': {},
+    'ip': '192.168.1.10',
+    'tools': 'running',
+}
+
+
+def load_config():
+    config = dict(DEFAULTS)
+    path = os.environ.get('FAKE_VMRUN_CONFIG')
+    if path and os.path.exists(path):
+        with open(path) as fp:
+            config.update(json.load(fp))
+    if not config['state_dir']:
+        config['state_dir'] = os.path.join(os.path.dirname(os.path.abspath(path or __file__)), 'fake-vmrun')
+    return config
+
+
+class State(object):
+    def __init__(self, state_dir, vmx):
+        self.vmx = vmx and os.path.abspath(vmx)
+        self.path = os.path.join(state_dir, hashlib.sha1((self.vmx or '').encode('utf-8')).hexdigest() + '.json')
+        self.data = {'vmx': self.vmx, 'power': 'off', 'snapshots': []}
+        if os.path.exists(self.path):
+            with open(self.path) as fp:
+                self.data.update(json.load(fp))
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        self.state_dir = state_dir
+
+    def save(self):
+        with open(self.path, 'w') as fp:
+            json.dump(self.data, fp)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def running(self):
+        running = []
+        for filename in os.listdir(self.state_dir):
+            with open(os.path.join(self.state_dir, filename)) as fp:
+                data = json.load(fp)
+            if data.get('power') == 'on':
+                running.append(data['vmx'])
+        return sorted(running)
+
+
+def fail(message):
+    print("Error: {}".format(message))
+    return 255
+
+
+def main(argv):
+    config = load_config()
+
+    args = list(argv)
+    while args and args[0] in ('-T', '-gu', '-gp', '-vp'):
+        args = args[2:]
+    if not args:
+        return fail("No command given")
+    command, args = args[0], args[1:]
+
+    latency = config['latency']
+    time.sleep(latency.get(command, latency.get('default', 0)))
+
+    failures = config['failures']
+    if random.random() < failures.get(command, failures.get('default', 0)):
+        return fail("Simulated failure of {}".format(command))
+
+    if command == 'list':
+        state = State(config['state_dir'], None)
+        running = state.running()
+        print("Total running VMs: {}".format(len(running)))
+        for vmx in running:
+            print(vmx)
+        return 0
+
+    vmx = args[0] if args else None
+    if not vmx or (command != 'clone' and not os.path.exists(vmx)):
+        return fail("Cannot open VM: {}, unknown file".format(vmx))
+    state = State(config['state_dir'], vmx)
+    power = state.data['power']
+
+    if command in ('start', 'unpause', 'reset'):
+        state.data['power'] = 'on'
+    elif command == 'stop':
+        if power == 'off':
+            return fail("The virtual machine is not powered on: {}".format(vmx))
+        state.data['power'] = 'off'
+    elif command == 'suspend':
+        if power != 'on':
+            return fail("The virtual machine is not powered on: {}".format(vmx))
+        state.data['power'] = 'suspended'
+    elif command == 'pause':
+        state.data['power'] = 'paused'
+    elif command == 'getGuestIPAddress':
+        if power != 'on':
+            return fail("The virtual machine is not powered on: {}".format(vmx))
+        print(config['ip'])
+    elif command == 'checkToolsState':
+        print(config['tools'] if power == 'on' else 'unknown')
+    elif command in ('runProgramInGuest', 'runScriptInGuest'):
+        if power != 'on':
+            return fail("The virtual machine is not powered on: {}".format(vmx))
+        print("Ran {}".format(" ".join(args[1:])))
+    elif command == 'listProcessesInGuest':
+        print("Process list: 1")
+        print("pid=1, owner=root, cmd=/sbin/init")
+    elif command == 'snapshot':
+        state.data['snapshots'].append(args[1])
+    elif command == 'deleteSnapshot':
+        if args[1] not in state.data['snapshots']:
+            return fail("The name does not uniquely identify one snapshot")
+        state.data['snapshots'].remove(args[1])
+    elif command == 'revertToSnapshot':
+        if args[1] not in state.data['snapshots']:
+            return fail("The name does not uniquely identify one snapshot")
+        state.data['power'] = 'off'
+    elif command == 'listSnapshots':
+        print("Total snapshots: {}".format(len(state.data['snapshots'])))
+        for snapshot in state.data['snapshots']:
+            print(snapshot)
+    elif command == 'clone':
+        dest = args[1]
+        if not os.path.isdir(os.path.dirname(os.path.abspath(dest))):
+            os.makedirs(os.path.dirname(os.path.abspath(dest)))
+        with open(vmx) as src, open(dest, 'w') as dst:
+            dst.write(src.read())
+    elif command == 'deleteVM':
+        state.delete()
+        return 0
+    # Everything else (shared folders, file copies...) just succeeds
+
+    state.save()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
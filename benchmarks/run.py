@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Benchmarks the mech command line against a fake vmrun and a local box server.
+
+Usage: run.py [options]
+
+Notes:
+    Every command runs the mech in this checkout in a throwaway HOME, with
+    a fake vmrun (see fake_vmrun.py) first in the PATH. Results are saved
+    as JSON; pass a previous results file to --compare to report the
+    benchmarks that got slower (or, for throughputs, lower) by more than
+    the threshold, in which case the exit status is 1.
+
+Options:
+    -o, --output FILE                Save the results to FILE (defaults to results/<version>-<time>.json)
+    -c, --compare FILE               Compare the results with a previous run
+    -n, --instances COUNTS           Numbers of instances to measure with [default: 1,10,100]
+    -r, --repeat N                   Measurements of each benchmark [default: 3]
+    -b, --box-size MB                Size of the box disk [default: 16]
+    -l, --latency SECONDS            Latency of fake vmrun commands [default: 0.05]
+        --start-latency SECONDS      Latency of fake vmrun start [default: 0.5]
+        --failures P                 Probability of a fake vmrun command failing [default: 0]
+    -t, --threshold PERCENT          Change reported as a regression [default: 10]
+    -k, --keep                       Keep the work directory
+    -v, --verbose                    Show the output of failed commands
+    -h, --help                       Print this help
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+from docopt import docopt
+
+from boxserver import BoxServer, make_box
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS_DIR)
+
+PROVISION = [
+    {"type": "shell", "inline": "echo provisioned"},
+    {"type": "shell", "inline": "uname -a"},
+    {"type": "shell", "inline": "true"},
+]
+
+
+def summarize(samples, unit='s'):
+    ordered = sorted(samples)
+    return {
+        'unit': unit,
+        'samples': samples,
+        'min': ordered[0] if ordered else None,
+        'max': ordered[-1] if ordered else None,
+        'mean': sum(ordered) / len(ordered) if ordered else None,
+        'median': ordered[len(ordered) // 2] if ordered else None,
+    }
+
+
+class Bench(object):
+    def __init__(self, work, options):
+        self.work = work
+        self.verbose = options['--verbose']
+        self.failures = 0
+        self.trace = os.path.join(work, 'trace.jsonl')
+
+        bin_dir = os.path.join(work, 'bin')
+        os.makedirs(bin_dir)
+        vmrun = os.path.join(bin_dir, 'vmrun')
+        with open(vmrun, 'w') as fp:
+            fp.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_vmrun.py')))
+        os.chmod(vmrun, 0o755)
+
+        config = os.path.join(work, 'fake_vmrun.json')
+        with open(config, 'w') as fp:
+            json.dump({
+                'state_dir': os.path.join(work, 'fake-vmrun'),
+                'latency': {
+                    'default': float(options['--latency']),
+                    'start': float(options['--start-latency']),
+                },
+                'failures': {'default': float(options['--failures'])},
+            }, fp)
+
+        self.env = dict(os.environ)
+        self.env.update({
+            'HOME': os.path.join(work, 'home'),
+            'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+            'PYTHONPATH': ROOT,
+            'FAKE_VMRUN_CONFIG': config,
+            'MECH_TRACE': self.trace,
+        })
+        self.env.pop('MECH_TRACE_PARENT', None)
+
+    def mech(self, *args, **kwargs):
+        """
+        Runs mech with the given arguments, returns the seconds it took.
+        """
+        cwd = kwargs.pop('cwd', self.work)
+        if os.path.exists(self.trace):
+            os.unlink(self.trace)
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, '-m', 'mech'] + list(args), cwd=cwd, env=self.env,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        elapsed = time.time() - start
+        if proc.returncode:
+            self.failures += 1
+            if self.verbose:
+                print("mech {} failed ({}):".format(" ".join(args), proc.returncode), file=sys.stderr)
+                print(output.decode('utf-8', 'replace'), file=sys.stderr)
+        return elapsed
+
+    def spans(self, name):
+        spans = []
+        if os.path.exists(self.trace):
+            with open(self.trace) as fp:
+                for line in fp:
+                    span = json.loads(line)
+                    if span['name'] == name:
+                        spans.append(span)
+        return spans
+
+    def environment(self, name, url, provision=None):
+        path = os.path.join(self.work, 'envs', name)
+        os.makedirs(path)
+        elapsed = self.mech('init', '--name', name, url, cwd=path)
+        if provision:
+            with open(os.path.join(path, 'Mechfile')) as fp:
+                mechfile = json.load(fp)
+            mechfile['provision'] = provision
+            with open(os.path.join(path, 'Mechfile'), 'w') as fp:
+                json.dump(mechfile, fp)
+        return path, elapsed
+
+
+def run(options):
+    repeat = int(options['--repeat'])
+    counts = [int(count) for count in options['--instances'].split(',')]
+    box_size = int(options['--box-size']) * 1024 * 1024
+    work = tempfile.mkdtemp(prefix='mech-bench-')
+    results = {}
+    bench = Bench(work, options)
+    try:
+        www = os.path.join(work, 'www')
+        os.makedirs(www)
+        make_box(os.path.join(www, 'bench.box'), box_size)
+
+        with BoxServer(www) as server:
+            url = server.url + '/bench.box'
+
+            print("Box download...", file=sys.stderr)
+            throughputs = []
+            for i in range(repeat):
+                bench.mech('box', 'add', '--force', 'bench', url)
+                for span in bench.spans('download'):
+                    throughputs.append(span['bytes'] / 1048576.0 / span['duration'])
+            results['box-download'] = summarize(throughputs, 'MB/s')
+
+            print("Box extract...", file=sys.stderr)
+            throughputs = []
+            for i in range(repeat):
+                path, elapsed = bench.environment('extract{}'.format(i), url)
+                bench.mech('up', cwd=path)
+                for span in bench.spans('extract'):
+                    throughputs.append(span['bytes'] / 1048576.0 / span['duration'])
+                bench.mech('destroy', '--force', cwd=path)
+            results['box-extract'] = summarize(throughputs, 'MB/s')
+
+            created = 0
+            for count in counts:
+                print("{} instances...".format(count), file=sys.stderr)
+                samples = []
+                while created < count:
+                    path, elapsed = bench.environment('bench{}'.format(created), url)
+                    samples.append(elapsed)
+                    created += 1
+                if samples:
+                    results['init[{}]'.format(count)] = summarize(samples)
+
+                names = ['bench{}'.format(i) for i in range(count - min(repeat, count), count)]
+                results['up[{}]'.format(count)] = summarize([bench.mech('up', name) for name in names])
+                results['status[{}]'.format(count)] = summarize([bench.mech('status', names[-1]) for i in range(repeat)])
+                results['list[{}]'.format(count)] = summarize([bench.mech('list') for i in range(repeat)])
+
+            print("Provision...", file=sys.stderr)
+            path, elapsed = bench.environment('provision', url, provision=PROVISION)
+            bench.mech('up', cwd=path)
+            results['provision'] = summarize([bench.mech('provision', cwd=path) for i in range(repeat)])
+    finally:
+        if options['--keep']:
+            print("Work directory kept in {}".format(work), file=sys.stderr)
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+    return results, bench.failures
+
+
+def compare(old, new, threshold):
+    """
+    Prints the change of every benchmark's median, returns the names of
+    the benchmarks that regressed by more than threshold percent.
+    """
+    regressions = []
+    print("{:<16} {:>15} {:>15} {:>9}".format('BENCHMARK', 'BEFORE', 'AFTER', 'CHANGE'))
+    for name in sorted(new['benchmarks']):
+        after = new['benchmarks'][name]
+        before = old['benchmarks'].get(name)
+        if not before or not before['median'] or after['median'] is None:
+            continue
+        change = (after['median'] - before['median']) / before['median'] * 100
+        # Throughputs regress when they go down, latencies when they go up:
+        worse = -change if after['unit'] == 'MB/s' else change
+        flag = ''
+        if worse > threshold:
+            regressions.append(name)
+            flag = ' <-'
+        print("{:<16} {:>9.3f} {:<2} {:>9.3f} {:<2} {:>+8.1f}%{}".format(
+            name, before['median'], before['unit'], after['median'], after['unit'], change, flag))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    options = docopt(__doc__)
+    if os.name == 'nt':
+        print("The benchmarks need a POSIX shell to run the fake vmrun", file=sys.stderr)
+        return 1
+
+    sys.path.insert(0, ROOT)
+    from mech import __version__
+
+    results, failures = run(options)
+    report = {
+        'mech_version': __version__,
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'options': dict((k, v) for k, v in options.items() if k not in ('--output', '--compare', '--keep', '--verbose', '--help')),
+        'failed_commands': failures,
+        'benchmarks': results,
+    }
+
+    output = options['--output']
+    if not output:
+        output = os.path.join(BENCHMARKS_DIR, 'results', '{}-{}.json'.format(__version__, time.strftime('%Y%m%d%H%M%S')))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as fp:
+        json.dump(report, fp, sort_keys=True, indent=2, separators=(',', ': '))
+    print("Results saved to {}".format(output), file=sys.stderr)
+    if failures:
+        print("{} mech commands failed (use --verbose to see them)".format(failures), file=sys.stderr)
+
+    if options['--compare']:
+        with open(options['--compare']) as fp:
+            old = json.load(fp)
+        regressions = compare(old, report, float(options['--threshold']))
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,16 +30,29 @@ def main():
         import sys
 
         from . import VERSION
+        from . import trace
+        from .errors import MechError
         from .mech import Mech
         from .utils import makedirs
 
         HOME = os.path.expanduser('~/.mech')
         makedirs(HOME)
         arguments = Mech.docopt(Mech.__doc__, argv=sys.argv[1:], version=VERSION)
-        return Mech(arguments)()
+        if arguments['--trace']:
+            trace.enable(arguments['--trace'])
+        with trace.span('mech', argv=sys.argv[1:]) as record:
+            try:
+                record['returncode'] = returncode = Mech(arguments)()
+            except MechError as exc:
+                import textwrap
+                from clint.textui import colored, puts_err
+                puts_err(colored.red(textwrap.fill(str(exc))))
+                record['returncode'] = returncode = 1
+        return returncode
     except KeyboardInterrupt:
         sys.stderr.write('\n')
 
 
 if __name__ == "__main__":
-    main()
+    import sys
+    sys.exit(main())
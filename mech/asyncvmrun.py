@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+# An asyncio flavour of VMrun (Python 3.5+ only, mech itself never imports
+# it). Every VMrun method is available and returns an awaitable:
+#
+#     vms = [AsyncVMrun(vmx) for vmx in vmxs]
+#     await asyncio.gather(*(vm.start() for vm in vms))
+#     ips = await asyncio.gather(*(vm.getGuestIPAddress() for vm in vms))
+
+from __future__ import absolute_import
+
+import os
+import time
+import signal
+import asyncio
+import logging
+import weakref
+import tempfile
+import subprocess
+
+from . import trace
+from . import process
+from .compat import b2s
+from .vmrun import VMrun
+
+logger = logging.getLogger(__name__)
+
+# vmrun processes run at once per event loop, unless a limiter is given
+DEFAULT_CONCURRENCY = 32
+
+_limiters = weakref.WeakKeyDictionary()
+
+
+def default_limiter():
+    loop = asyncio.get_event_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = _limiters[loop] = asyncio.Semaphore(DEFAULT_CONCURRENCY)
+    return limiter
+
+
+def kill_tree(proc):
+    """
+    Kills a process started by run() and all of its children.
+    """
+    if proc.returncode is not None:
+        return
+    try:
+        if os.name == "nt":
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=process.startupinfo())
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+
+async def _read(pipe, buf, callback, is_err):
+    while True:
+        line = await pipe.readline()
+        if not line:
+            break
+        line = b2s(line)
+        buf.append(line)
+        if callback:
+            callback(line.rstrip('\r\n'), is_err)
+
+
+async def run(cmds, stream=None, timeout=None, limiter=None, max_output=None):
+    """
+    Runs a command and returns a (returncode, stdoutdata, stderrdata) tuple,
+    like process.run(). Waits for a slot of limiter (a semaphore) first.
+
+    The command and all of its children are killed when it runs for longer
+    than timeout seconds or when the awaiting task is cancelled.
+    """
+    if limiter is None:
+        limiter = default_limiter()
+    async with limiter:
+        proc = await asyncio.create_subprocess_exec(
+            *cmds, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=os.name != "nt", startupinfo=process.startupinfo(),
+            env=trace.child_env(), limit=process.MAX_OUTPUT)
+        stdout = process.OutputBuffer(max_output)
+        stderr = process.OutputBuffer(max_output)
+        communicate = asyncio.gather(
+            _read(proc.stdout, stdout, stream, False),
+            _read(proc.stderr, stderr, stream, True),
+            proc.wait(),
+        )
+        try:
+            await asyncio.wait_for(communicate, timeout)
+        except asyncio.TimeoutError:
+            logger.error("Command timed out after %s seconds", timeout)
+            kill_tree(proc)
+            await proc.wait()
+        except BaseException:
+            # Cancelled (or failed): don't leave the process behind
+            kill_tree(proc)
+            raise
+        return proc.returncode, stdout.getvalue(), stderr.getvalue()
+
+
+class AsyncVMrun(VMrun):
+    """
+    VMrun whose methods are coroutines, running vmrun processes through an
+    asyncio.Semaphore (limiter) shared by default by all the instances in
+    the same event loop. Commands are never sent to the mech daemon (which is
+    only told to forget the VM states it keeps).
+    """
+
+    def __init__(self, vmx_file=None, user=None, password=None, executable=None, provider=None, timeout=None, limiter=None):
+        super(AsyncVMrun, self).__init__(vmx_file, user=user, password=password, executable=executable, provider=provider, timeout=timeout)
+        self.limiter = limiter
+
+    async def vmrun(self, cmd, *args, **kwargs):
+        quiet = kwargs.pop('quiet', False)
+        arguments = kwargs.pop('arguments', ())
+        stream = kwargs.pop('stream', None)
+        timeout = kwargs.pop('timeout', None)
+        if timeout is None:
+            # Guest commands pass timeout=None when they have no timeout of their own
+            timeout = self.timeout
+
+        args = list(filter(None, args)) + list(filter(None, arguments))
+        cmds = self.command_line(cmd, args)
+
+        if stream and not callable(stream):
+            stream = process.line_printer(cmd if stream is True else stream)
+        parent = trace.current()
+        start = time.time()
+        returncode = None
+        try:
+            returncode, stdoutdata, stderrdata = await run(cmds, stream=stream, timeout=timeout, limiter=self.limiter,
+                                                           max_output=process.MAX_OUTPUT if stream else None)
+        finally:
+            trace.record('vmrun', start, parent=parent, command=cmd, returncode=returncode)
+        await asyncio.get_event_loop().run_in_executor(None, self.changed, cmd)
+        if stream:
+            # Output was already forwarded as it was produced:
+            quiet = True
+
+        return self.result(returncode, stdoutdata, stderrdata, quiet=quiet)
+
+    async def fileExistsInGuest(self, file, quiet=False):
+        '''Check if a file exists in Guest OS'''
+        return 'not' not in (await self.vmrun('fileExistsInGuest', self.vmx_file, file, quiet=quiet) or 'not')
+
+    async def directoryExistsInGuest(self, path, quiet=False):
+        '''Check if a directory exists in Guest OS'''
+        return 'not' not in (await self.vmrun('directoryExistsInGuest', self.vmx_file, path, quiet=quiet) or 'not')
+
+    async def getGuestIPAddress(self, wait=True, quiet=False, lookup=False):
+        '''Gets the IP address of the guest'''
+        if lookup is True:
+            await self.runScriptInGuest('/bin/sh', "ifconfig | grep -Eo 'inet (addr:)?([0-9]*\\.){3}[0-9]*' | grep -Eo '([0-9]*\\.){3}[0-9]*' | grep -v '127.0.0.1' > /tmp/ip_address", quiet=quiet)
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                await self.copyFileFromGuestToHost('/tmp/ip_address', path, quiet=quiet)
+                with open(path) as fp:
+                    ip_addresses = fp.read().split()
+                return ip_addresses[0] if ip_addresses else None
+            finally:
+                os.unlink(path)
+        ip = await self.vmrun('getGuestIPAddress', self.vmx_file, '-wait' if wait else None, quiet=quiet)
+        if ip == 'unknown':
+            ip = ''
+        return ip
+
+    async def installedTools(self, quiet=False):
+        state = await self.checkToolsState(quiet=quiet)
+        return state in ('installed', 'running')
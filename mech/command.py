@@ -76,11 +76,14 @@ class Command(object):
         if self.subcommand_name in self.arguments:
             cmd = self.arguments[self.subcommand_name]
             cmd_attr = cmd.replace('-', '_')
+            if not hasattr(self, cmd_attr):
+                # Commands named after reserved words have a trailing underscore
+                cmd_attr += '_'
             if hasattr(self, cmd_attr):
                 klass = getattr(self, cmd_attr)
                 meth_func = get_meth_func(klass)
                 if meth_func:
-                    cmd = meth_func.__name__.replace('_', '-')
+                    cmd = meth_func.__name__.rstrip('_').replace('_', '-')
                 name = '{} {}'.format(self.__class__.__name__, cmd)
                 if klass.__doc__:
                     arguments = self.docopt(klass.__doc__, argv=self.arguments.get(self.argv_name, []), name=name)
@@ -68,3 +68,15 @@ get_meth_func = lambda klass: operator.attrgetter(meth_func)(klass) if hasattr(k
 
 #: "safe" form of ``b``. Checks for binary type before operating.
 b2s = lambda bytestr: s(bytestr) if isinstance(bytestr, binary_type) else bytestr
+
+#: Shell quoting
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+#: Executables in the PATH
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from . import utils
+from . import process
+from . import vmrun as _vmrun
+from .vmx import VMX
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = os.path.join(utils.HOME, 'daemon.sock')
+
+# Set to 0 to keep mech from using a running daemon
+DAEMON_ENV = 'MECH_DAEMON'
+
+# vmrun commands which only read state; their results are reused for the
+# state TTL and every other command run through the daemon drops them.
+READ_ONLY = ('list', 'getGuestIPAddress', 'checkToolsState', 'listSnapshots')
+
+# Commands which wait on the guest for as long as it takes (and read-only
+# ones told to -wait); they don't take a worker, so they can't starve the
+# others.
+LONG_RUNNING = ('runProgramInGuest', 'runScriptInGuest')
+
+DEFAULT_JOBS = 8
+DEFAULT_TTL = 2.0
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Daemon(object):
+    """
+    Keeps the instance index and recent VM state in memory and runs vmrun
+    commands for mech processes: at most `jobs` commands changing VMs and
+    `jobs` reading their state at once (so reads are never queued behind
+    slow changes), and the long running guest commands without a limit.
+    """
+
+    def __init__(self, jobs=DEFAULT_JOBS, ttl=DEFAULT_TTL):
+        self.started = time.time()
+        self.ttl = ttl
+        self.workers = threading.BoundedSemaphore(jobs)
+        self.readers = threading.BoundedSemaphore(jobs)
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.generation = 0
+        self.index = {}
+        self.index_mtime = None
+        self.vmrun = _vmrun.VMrun()
+        self.hits = 0
+        self.misses = 0
+
+    def ping(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': time.time() - self.started,
+            'executable': self.vmrun.executable,
+            'provider': self.vmrun.provider,
+            'cached': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def instances(self):
+        """
+        Returns the instance index, read again only when it changes.
+        """
+        index_path = os.path.join(utils.DATA_DIR, 'index')
+        try:
+            mtime = os.path.getmtime(index_path)
+        except OSError:
+            mtime = None
+        with self.lock:
+            if mtime != self.index_mtime:
+                self.index = utils.instances()
+                self.index_mtime = mtime
+            return self.index
+
+    def invalidate(self):
+        with self.lock:
+            self.cache.clear()
+            self.generation += 1
+
+    def run(self, command, args=(), user=None, password=None, timeout=None, cwd=None):
+        """
+        Runs a vmrun command, returns its (returncode, stdout, stderr).
+        """
+        key = (command, tuple(args), user)
+        read_only = command in READ_ONLY
+        if read_only:
+            with self.lock:
+                cached = self.cache.get(key)
+                if cached and time.time() - cached[0] < self.ttl:
+                    self.hits += 1
+                    return cached[1]
+                self.misses += 1
+                generation = self.generation
+        else:
+            self.invalidate()
+
+        cmds = [self.vmrun.executable, '-T', self.vmrun.provider]
+        if user:
+            cmds.extend(('-gu', user))
+        if password:
+            cmds.extend(('-gp', password))
+        cmds.append(command)
+        cmds.extend(args)
+        if command in LONG_RUNNING or '-wait' in args:
+            result = process.run(cmds, timeout=timeout, cwd=cwd)
+        else:
+            with self.readers if read_only else self.workers:
+                result = process.run(cmds, timeout=timeout, cwd=cwd)
+
+        if read_only:
+            with self.lock:
+                # Unless a VM changed while it ran (the result may be stale)
+                if not result[0] and generation == self.generation:
+                    self.cache[key] = (time.time(), result)
+        else:
+            # Reads which ran along with the command may have cached the
+            # state before it
+            self.invalidate()
+        return result
+
+    def status(self, instance):
+        """
+        Returns the state, IP address, VMware Tools state and profiles of an
+        instance.
+        """
+        data = self.instances().get(instance)
+        if not data or not data.get('path'):
+            raise DaemonError("Cannot find instance {}".format(instance))
+        path = os.path.join(data['path'], '.mech', data['machine']) if data.get('machine') else os.path.join(data['path'], '.mech')
+        vmx = utils.get_vmx(silent=True, path=path)
+        status = {'instance': instance, 'path': data['path'], 'vmx': vmx, 'state': 'missing', 'ip': None, 'tools': None, 'profiles': []}
+        if not vmx:
+            return status
+        status['profiles'] = VMX.load(vmx).profiles
+
+        returncode, stdout, stderr = self.run('list')
+        running = [line.strip() for line in stdout.splitlines()[1:]] if not returncode else []
+        if os.path.abspath(vmx) not in running:
+            status['state'] = 'poweroff'
+            return status
+        status['state'] = 'running'
+        returncode, stdout, stderr = self.run('getGuestIPAddress', [vmx])
+        ip = stdout.strip() if not returncode else None
+        status['ip'] = ip if ip != 'unknown' else ''
+        returncode, stdout, stderr = self.run('checkToolsState', [vmx])
+        status['tools'] = stdout.strip() if not returncode else None
+        return status
+
+    def call(self, method, params):
+        if method == 'ping':
+            return self.ping()
+        if method == 'instances':
+            return self.instances()
+        if method == 'status':
+            return self.status(params['instance'])
+        if method == 'vmrun':
+            returncode, stdout, stderr = self.run(
+                params['command'], params.get('args', ()), user=params.get('user'), password=params.get('password'),
+                timeout=params.get('timeout'), cwd=params.get('cwd'))
+            return {'returncode': returncode, 'stdout': stdout, 'stderr': stderr}
+        if method == 'invalidate':
+            self.invalidate()
+            return True
+        raise DaemonError("Unknown method {}".format(method))
+
+
+class Handler(socketserver.StreamRequestHandler):
+    # Requests and responses are JSON objects, one per line:
+    #
+    #     {"method": "status", "params": {"instance": "first"}}
+    #     {"result": {"state": "running", "ip": "192.168.1.10", ...}}
+    #
+    # A connection can carry any number of requests.
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                request = json.loads(line.decode('utf-8'))
+                method = request.get('method')
+                if method == 'shutdown':
+                    response = {'result': True}
+                    threading.Thread(target=self.server.shutdown).start()
+                else:
+                    response = {'result': self.server.daemon.call(method, request.get('params') or {})}
+            except DaemonError as exc:
+                response = {'error': str(exc)}
+            except Exception as exc:
+                logger.exception("Request failed")
+                response = {'error': '{}: {}'.format(type(exc).__name__, exc)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def serve(path=SOCKET_PATH, jobs=DEFAULT_JOBS, ttl=DEFAULT_TTL):
+    """
+    Serves the daemon API on a Unix socket at path until asked to shut down.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise DaemonError("The mech daemon needs Unix domain sockets")
+
+    # The daemon runs vmrun itself, it mustn't send the commands to itself:
+    os.environ[DAEMON_ENV] = '0'
+
+    client = Client(path)
+    if client.connect():
+        client.close()
+        raise DaemonError("The mech daemon is already running")
+    if os.path.exists(path):
+        os.unlink(path)
+    utils.makedirs(os.path.dirname(path))
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    umask = os.umask(0o077)  # Only this user can talk to the daemon
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon = Daemon(jobs=jobs, ttl=ttl)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+class Client(object):
+    """
+    A connection to a running daemon.
+    """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self.sock = None
+        self.fp = None
+
+    def connect(self):
+        """
+        Connects to the daemon, returns False if it's not running.
+        """
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self.path):
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            return False
+        self.sock = sock
+        self.fp = sock.makefile('rb')
+        return True
+
+    def close(self):
+        if self.sock:
+            self.fp.close()
+            self.sock.close()
+            self.sock = self.fp = None
+
+    def call(self, method, **params):
+        if not self.sock and not self.connect():
+            raise DaemonError("The mech daemon is not running")
+        request = json.dumps({'method': method, 'params': params}) + '\n'
+        try:
+            self.sock.sendall(request.encode('utf-8'))
+            line = self.fp.readline()
+        except socket.error as exc:
+            self.close()
+            raise DaemonError("Lost connection to the mech daemon: {}".format(exc))
+        if not line:
+            self.close()
+            raise DaemonError("The mech daemon closed the connection")
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise DaemonError(response['error'])
+        return response['result']
+
+
+_local = threading.local()
+
+
+def invalidate():
+    """
+    Tells a running daemon to forget the VM states it keeps, after a
+    command changed a VM without going through it.
+    """
+    connection = client()
+    if connection:
+        try:
+            connection.call('invalidate')
+        except DaemonError as exc:
+            logger.debug("Cannot invalidate the daemon cache: %s", exc)
+
+
+def client():
+    """
+    Returns this thread's connection to the daemon, or None when it's not
+    running (or disabled in MECH_DAEMON), in which case mech runs commands
+    directly.
+    """
+    if os.environ.get(DAEMON_ENV, '1') in ('0', 'no', 'false'):
+        return None
+    if not hasattr(_local, 'client'):
+        _local.client = Client()
+        if not _local.client.connect():
+            _local.client = None
+    return _local.client
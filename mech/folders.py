@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import logging
+import posixpath
+
+from . import trace
+from . import process
+from .errors import MechfileError
+from .compat import quote
+
+logger = logging.getLogger(__name__)
+
+TYPES = ('rsync', 'tar')
+
+# Never synced: the VM itself lives there
+ALWAYS_EXCLUDE = ['.mech']
+
+
+def synced_folders(mechfile, path):
+    """
+    Returns the "synced_folders" of a Mechfile, each a dict with the type,
+    the absolute source (relative ones are relative to path), destination,
+    exclude patterns and whether to delete files missing in the source.
+    """
+    folders = []
+    for folder in mechfile.get('synced_folders') or []:
+        folder_type = folder.get('type', 'rsync')
+        if folder_type not in TYPES:
+            raise MechfileError("Unknown synced folder type '{}' (use {})".format(folder_type, " or ".join(TYPES)))
+        if not folder.get('destination'):
+            raise MechfileError("Synced folders need a destination")
+        folders.append({
+            'type': folder_type,
+            'source': os.path.normpath(os.path.join(path, os.path.expanduser(folder.get('source', '.')))),
+            'destination': folder['destination'],
+            'exclude': ALWAYS_EXCLUDE + list(folder.get('exclude') or []),
+            'delete': bool(folder.get('delete', False)),
+        })
+    return folders
+
+
+def rsync(folder, config_ssh_file, host):
+    """
+    Syncs a folder with rsync over ssh, returns True if it succeeded or
+    None if rsync isn't installed in the host.
+    """
+    source = folder['source']
+    if os.path.isdir(source):
+        source = os.path.join(source, '')
+    destination = folder['destination']
+    cmds = [
+        'rsync', '--archive', '--compress',
+        '--rsh', 'ssh -F {}'.format(quote(config_ssh_file)),
+        '--rsync-path', 'mkdir -p {} && rsync'.format(quote(destination if source.endswith('/') else posixpath.dirname(destination) or '.')),
+    ]
+    if folder['delete']:
+        cmds.append('--delete')
+    for pattern in folder['exclude']:
+        cmds.extend(('--exclude', pattern))
+    cmds.extend((source, '{}:{}'.format(host, destination)))
+    logger.debug(" ".join(cmds))
+    try:
+        returncode, stdoutdata, stderrdata = process.run(cmds)
+    except OSError:
+        return None
+    if returncode:
+        logger.error(stderrdata.strip() or "rsync failed ({})".format(returncode))
+        return False
+    return True
+
+
+def tar(folder, config_ssh_file, host):
+    """
+    Syncs a folder streaming a tar archive of the files that changed, and
+    removes the files missing in the source if the folder has "delete".
+    """
+    from .transfer import Transfer
+    transfer = Transfer(config_ssh_file, host, delta=True, exclude=folder['exclude'])
+    return transfer.upload(folder['source'], folder['destination'], delete=folder['delete']) is not None
+
+
+def sync(folder, config_ssh_file, host):
+    """
+    Copies the files of a synced folder which changed since the last sync
+    to the machine. Returns True if it succeeded.
+    """
+    with trace.span('sync', type=folder['type'], source=folder['source'], destination=folder['destination']) as record:
+        if folder['type'] == 'rsync':
+            synced = rsync(folder, config_ssh_file, host)
+            if synced is None:
+                logger.warning("Cannot run rsync, using tar for %s", folder['source'])
+                synced = tar(folder, config_ssh_file, host)
+        else:
+            synced = tar(folder, config_ssh_file, host)
+        record['ok'] = synced
+    return synced
+
+
+def sync_paths(folder, paths, config_ssh_file, host):
+    """
+    Copies only the given changed paths of a synced folder to the machine,
+    all in one tar stream, and removes the deleted ones there if the folder
+    has "delete". Returns the number of paths synced, or None if it failed.
+    """
+    from .transfer import Transfer, is_excluded, normalize
+    source, destination = folder['source'], folder['destination']
+    transfer = Transfer(config_ssh_file, host)
+    if not os.path.isdir(source):
+        if source not in paths or not os.path.exists(source):
+            return 0
+        return 1 if transfer.upload(source, destination) is not None else None
+
+    prefix = os.path.join(source, '')
+    names = set()
+    for path in paths:
+        if path == source:
+            names.add('.')
+        elif path.startswith(prefix):
+            name = normalize(os.path.relpath(path, source))
+            if not is_excluded(name, folder['exclude']):
+                names.add(name)
+    if not names:
+        return 0
+    existing = sorted(name for name in names if os.path.exists(os.path.join(source, name)))
+    deleted = sorted(names.difference(existing))
+    with trace.span('sync', type='watch', source=source, destination=destination, paths=len(names)) as record:
+        record['ok'] = False
+        if existing and transfer.upload(source, destination, names=existing) is None:
+            return None
+        if deleted and folder['delete']:
+            command = "cd {} && rm -rf -- {}".format(quote(destination), " ".join(quote(name) for name in deleted))
+            if transfer.remote(command) is None:
+                return None
+        record['ok'] = True
+    return len(names)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import json
+import logging
+
+from .errors import MechfileError, CommandFailed
+
+logger = logging.getLogger(__name__)
+
+# Finding the NAT network runs vmrun, so its name is remembered here (with
+# the mtime of its NAT configuration, see nat_network()):
+NAT_CACHE = os.path.join(os.path.expanduser('~'), '.mech', 'nat.json')
+
+PROTOCOLS = ('tcp', 'udp')
+
+FORWARD_RE = re.compile(r'^\s*(\d+)\s*=\s*(\d{1,3}(?:\.\d{1,3}){3}):(\d+)')
+LISTING_RE = re.compile(r'\b(tcp|udp)\b\D*?(\d+)\D*?(\d{1,3}(?:\.\d{1,3}){3})\D*?(\d+)', re.IGNORECASE)
+
+_parsed = {}
+
+
+def conf_path(network):
+    """
+    Returns the path of the NAT configuration VMware keeps for network.
+    """
+    if sys.platform == 'darwin':
+        return os.path.join('/Library/Preferences/VMware Fusion', network, 'nat.conf')
+    if sys.platform == 'win32':
+        return os.path.join(os.environ.get('ProgramData', 'C:\\ProgramData'), 'VMware', 'vmnetnat.conf')
+    return os.path.join('/etc/vmware', network, 'nat', 'nat.conf')
+
+
+def parse_conf(text):
+    """
+    Returns the port forwards in the text of a NAT configuration.
+    """
+    forwards = []
+    protocol = None
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line.startswith('['):
+            section = line.strip('[]').lower()
+            protocol = section[len('incoming'):] if section in ('incomingtcp', 'incomingudp') else None
+            continue
+        match = protocol and FORWARD_RE.match(line)
+        if match:
+            forwards.append({'protocol': protocol, 'host_port': int(match.group(1)), 'guest_ip': match.group(2), 'guest_port': int(match.group(3))})
+    return forwards
+
+
+def parse_listing(output):
+    """
+    Returns the port forwards in the output of `vmrun listPortForwardings`.
+    """
+    forwards = []
+    for line in output.splitlines():
+        match = LISTING_RE.search(line)
+        if match:
+            forwards.append({'protocol': match.group(1).lower(), 'host_port': int(match.group(2)), 'guest_ip': match.group(3), 'guest_port': int(match.group(4))})
+    return forwards
+
+
+def conf_key(network):
+    """
+    Returns the path and mtime of the NAT configuration of network, or None
+    if it can't be read.
+    """
+    path = conf_path(network)
+    try:
+        return [path, os.path.getmtime(path)]
+    except (IOError, OSError):
+        return None
+
+
+def nat_network(vmrun):
+    """
+    Returns the name of the host's NAT network (usually vmnet8). The host
+    networks are listed again only when the NAT configuration of the one
+    remembered changed (VMware rewrites it when networks are edited) or
+    can't be read.
+    """
+    try:
+        with open(NAT_CACHE) as fp:
+            cache = json.load(fp)
+        network = cache.get('network')
+        if network and cache.get('conf') == conf_key(network):
+            return network
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    for line in (vmrun.listHostNetworks(quiet=True) or '').splitlines():
+        fields = line.split()
+        if len(fields) > 2 and fields[2] == 'nat':
+            network = fields[1]
+            break
+    else:
+        return None
+    key = conf_key(network)
+    if key:
+        try:
+            with open(NAT_CACHE, 'w') as fp:
+                json.dump({'network': network, 'conf': key}, fp)
+        except (IOError, OSError):
+            pass
+    return network
+
+
+def port_forwards(vmrun, network):
+    """
+    Returns the port forwards of the NAT network, each a dict with the
+    protocol, host_port, guest_ip and guest_port. They're parsed from the
+    NAT configuration (again only when it changes) if it can be read, and
+    asked to vmrun otherwise.
+    """
+    path = conf_path(network)
+    try:
+        key = (path, os.path.getmtime(path))
+        if key not in _parsed:
+            with open(path) as fp:
+                _parsed.clear()
+                _parsed[key] = parse_conf(fp.read())
+        return list(_parsed[key])
+    except (IOError, OSError):
+        return parse_listing(vmrun.listPortForwardings(network, quiet=True) or '')
+
+
+def declared_forwards(mechfile):
+    """
+    Returns the "forwarded_ports" of a Mechfile, each a dict with the
+    protocol, host_port, guest_port and description.
+    """
+    forwards = []
+    for forward in mechfile.get('forwarded_ports') or []:
+        protocol = forward.get('protocol', 'tcp')
+        if protocol not in PROTOCOLS:
+            raise MechfileError("Unknown forwarded port protocol '{}' (use {})".format(protocol, " or ".join(PROTOCOLS)))
+        try:
+            guest_port, host_port = int(forward['guest']), int(forward['host'])
+        except (KeyError, TypeError, ValueError):
+            raise MechfileError("Forwarded ports need a \"guest\" and a \"host\" port")
+        forwards.append({'protocol': protocol, 'host_port': host_port, 'guest_port': guest_port, 'description': forward.get('description')})
+    return forwards
+
+
+def apply_forwards(vmrun, network, forwards, guest_ip, owner=None):
+    """
+    Makes the NAT network forward the given ports to guest_ip, reading the
+    existing forwards once and only setting those missing or pointing
+    elsewhere. A host port forwarded to another guest is only taken over
+    when owner(protocol, host_port), which names the other instance whose
+    Mechfile forwards it, returns None. Returns the (set, unchanged)
+    forwards; raises MechError if one can't be set.
+    """
+    existing = dict(((forward['protocol'], forward['host_port']), forward) for forward in port_forwards(vmrun, network))
+    applied, unchanged = [], []
+    for forward in forwards:
+        current = existing.get((forward['protocol'], forward['host_port']))
+        if current and current['guest_ip'] == guest_ip and current['guest_port'] == forward['guest_port']:
+            unchanged.append(forward)
+            continue
+        if current and current['guest_ip'] != guest_ip:
+            other = owner and owner(forward['protocol'], forward['host_port'])
+            if other:
+                raise MechfileError("Host port {} ({}) is already forwarded to {}:{} and '{}' forwards it as well".format(
+                    forward['host_port'], forward['protocol'], current['guest_ip'], current['guest_port'], other))
+            logger.warning("Host port %s (%s) was forwarded to %s:%s, forwarding it to %s:%s",
+                           forward['host_port'], forward['protocol'], current['guest_ip'], current['guest_port'], guest_ip, forward['guest_port'])
+        if vmrun.setPortForwarding(network, forward['protocol'], str(forward['host_port']), guest_ip, str(forward['guest_port']), forward['description'], quiet=True) is None:
+            raise CommandFailed("Cannot forward {} port {} to {}".format(forward['protocol'], forward['host_port'], forward['guest_port']))
+        applied.append(forward)
+    return applied, unchanged
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import re
+import logging
+
+from . import utils
+from .errors import MechfileError
+from .vmx import VMX, is_running
+from .compat import quote
+
+logger = logging.getLogger(__name__)
+
+TYPES = ('hostonly',)
+
+# VMware's default host-only network
+DEFAULT_NETWORK = 'vmnet1'
+DEFAULT_NETMASK = '255.255.255.0'
+
+# Adapters added by mech are named so they're found again
+DISPLAY_NAME = 'mech network {}'
+
+IP_RE = re.compile(r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$')
+
+CONFIGURE_SCRIPT = """
+iface=
+for dev in /sys/class/net/*; do
+    [ "$(cat "$dev/address" 2>/dev/null)" = {mac} ] && iface=$(basename "$dev")
+done
+if [ -z "$iface" ]; then
+    iface=$(ifconfig -a 2>/dev/null | awk -v mac={mac} '/^[^ \\t]/ {{ name = $1 }} tolower($0) ~ mac {{ sub(":$", "", name); print name; exit }}')
+fi
+[ -n "$iface" ] || {{ echo "No interface with address {mac}" >&2; exit 1; }}
+if command -v ip >/dev/null 2>&1; then
+    sudo -n ip addr flush dev "$iface" && sudo -n ip addr add {ip}/{prefix} dev "$iface" && sudo -n ip link set "$iface" up
+else
+    sudo -n ifconfig "$iface" inet {ip} netmask {netmask} up
+fi
+"""
+
+
+def parse_ip(ip):
+    match = IP_RE.match(ip or '')
+    if not match or any(int(octet) > 255 for octet in match.groups()):
+        return None
+    return [int(octet) for octet in match.groups()]
+
+
+def mac_address(ip):
+    """
+    Returns the static MAC address of the adapter for ip, in the range
+    VMware reserves for static addresses (00:50:56:00:00:00-3F:FF:FF).
+    """
+    octets = parse_ip(ip)
+    return '00:50:56:{:02x}:{:02x}:{:02x}'.format(octets[1] & 0x3f, octets[2], octets[3])
+
+
+def host_networks(mechfile):
+    """
+    Returns the "networks" of a Mechfile, each a dict with the type, the
+    VMware network, its static ip (or None for DHCP), netmask, prefix length
+    and MAC address.
+    """
+    networks = []
+    for network in mechfile.get('networks') or []:
+        network_type = network.get('type', 'hostonly')
+        if network_type not in TYPES:
+            raise MechfileError("Unknown network type '{}' (use {})".format(network_type, " or ".join(TYPES)))
+        ip = network.get('ip')
+        if ip and not parse_ip(ip):
+            raise MechfileError("Invalid network ip '{}'".format(ip))
+        netmask = network.get('netmask', DEFAULT_NETMASK)
+        mask = parse_ip(netmask)
+        bits = ''.join('{:08b}'.format(octet) for octet in mask or [])
+        if not mask or '01' in bits:
+            raise MechfileError("Invalid network netmask '{}'".format(netmask))
+        networks.append({
+            'type': network_type,
+            'network': network.get('network', DEFAULT_NETWORK),
+            'ip': ip,
+            'netmask': netmask,
+            'prefix': bits.count('1'),
+            'mac': mac_address(ip) if ip else None,
+        })
+    return networks
+
+
+def check_mac_addresses(mechfile):
+    """
+    Raises MechfileError if static addresses in the networks of a Mechfile
+    (in any of its machines) would get the same MAC address, which only
+    keeps some of the bits of the address.
+    """
+    mechfiles = [mechfile] + [utils.machine_mechfile(mechfile, machine) for machine in utils.machine_names(mechfile)]
+    addresses = {}
+    for network in [network for mechfile in mechfiles for network in host_networks(mechfile)]:
+        ip, mac = network['ip'], network['mac']
+        if ip and addresses.setdefault(mac, ip) != ip:
+            raise MechfileError("Network ips {} and {} would get the same MAC address ({}), which only keeps the last 22 bits of an address".format(addresses[mac], ip, mac))
+
+
+def static_ip(mechfile):
+    """
+    Returns the first static IP address of the Mechfile's networks, where
+    the machine can be reached without asking VMware for its address.
+    """
+    for network in host_networks(mechfile):
+        if network['ip']:
+            return network['ip']
+
+
+def apply_vmx(path, networks):
+    """
+    Adds a network adapter to the VMX in path for each of the networks (and
+    disables those added for networks no longer there). The file is only
+    rewritten when something changes, and never while the machine is
+    running or suspended. Returns the changed keys.
+    """
+    vmx = VMX.load(path)
+    adapters = {}
+    used = set()
+    for key in vmx:
+        match = re.match(r'^ethernet(\d+)\.', key, re.IGNORECASE)
+        if match:
+            used.add(int(match.group(1)))
+            name = vmx.get(key) if key.lower().endswith('.displayname') else None
+            if name and name.startswith(DISPLAY_NAME.format('')):
+                adapters[name] = int(match.group(1))
+
+    virtual_dev = vmx.get('ethernet0.virtualDev', 'e1000')
+    changed = []
+    for i, network in enumerate(networks):
+        name = DISPLAY_NAME.format(i + 1)
+        index = adapters.pop(name, None)
+        if index is None:
+            index = min(set(range(len(used) + 1)) - used)
+            used.add(index)
+        prefix = 'ethernet{}.'.format(index)
+        settings = [
+            ('present', True),
+            ('displayName', name),
+            ('virtualDev', virtual_dev),
+            ('connectionType', 'hostonly' if network['network'] == DEFAULT_NETWORK else 'custom'),
+        ]
+        if network['network'] != DEFAULT_NETWORK:
+            settings.append(('vnet', network['network']))
+        if network['mac']:
+            settings.extend((('addressType', 'static'), ('address', network['mac'])))
+        else:
+            settings.append(('addressType', 'generated'))
+        changed.extend(prefix + key for key, value in settings if vmx.set(prefix + key, value))
+    for index in adapters.values():
+        key = 'ethernet{}.present'.format(index)
+        if vmx.set(key, False):
+            changed.append(key)
+
+    if changed:
+        if is_running(path) or vmx.suspended:
+            logger.warning("Cannot change the network adapters while the machine is running or suspended")
+            return []
+        vmx.save()
+    return changed
+
+
+def configure_script(networks):
+    """
+    Returns a shell script assigning the static addresses of networks to
+    the guest's interfaces with their MAC addresses.
+    """
+    return "".join(CONFIGURE_SCRIPT.format(
+        mac=quote(network['mac']),
+        ip=network['ip'],
+        prefix=network['prefix'],
+        netmask=network['netmask'],
+    ) for network in networks if network['ip'])
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import io
+import os
+import re
+import json
+import time
+import gzip
+import hashlib
+import logging
+import threading
+import subprocess
+
+from . import trace
+from . import process
+from .vmrun import default_executable
+from .compat import b2s, which
+
+logger = logging.getLogger(__name__)
+
+PROVIDER = 'vmware_desktop'
+COMPRESSIONS = ('gzip', 'zstd')
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 10}
+
+# Files VMware writes while running which don't belong in a box
+EXCLUDE = ['*.log', '*.lck', '*.scoreboard', '*.vmem', '*.vmss', '*.tmp', '*.vmx~', 'caches']
+
+# Disk extents (data files), as opposed to the descriptors vdiskmanager takes
+EXTENT_RE = re.compile(r'-(s\d{3}|f\d{3}|flat|delta)\.vmdk$', re.IGNORECASE)
+
+# Parent disk of a delta disk (snapshot or linked clone), in its descriptor,
+# which sparse disks embed within their first sectors
+PARENT_RE = re.compile(br'parentFileNameHint\s*=\s*"([^"]*)"')
+DESCRIPTOR_SIZE = 64 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def vdiskmanager():
+    """
+    Returns the path of vmware-vdiskmanager, which is installed next to
+    vmrun, or None.
+    """
+    vmrun = default_executable()
+    if vmrun:
+        for filename in ('vmware-vdiskmanager', 'vmware-vdiskmanager.exe'):
+            executable = os.path.join(os.path.dirname(vmrun), filename)
+            if os.path.exists(executable):
+                return executable
+    return which('vmware-vdiskmanager')
+
+
+def disks(path):
+    """
+    Returns the virtual disk descriptors in path.
+    """
+    return sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                  if filename.lower().endswith('.vmdk') and not EXTENT_RE.search(filename))
+
+
+def parent_disk(disk):
+    """
+    Returns the (absolute) path of the parent of a delta disk (a snapshot
+    or a linked clone), or None.
+    """
+    with open(disk, 'rb') as fp:
+        match = PARENT_RE.search(fp.read(DESCRIPTOR_SIZE))
+    if match:
+        return os.path.normpath(os.path.join(os.path.dirname(disk), b2s(match.group(1))))
+
+
+def parent_disks(path):
+    """
+    Returns the parent disks of the virtual disks in path.
+    """
+    return [parent for parent in map(parent_disk, disks(path)) if parent]
+
+
+def linked_disks(path):
+    """
+    Returns the parent disks outside path the virtual disks in path depend
+    on, which makes them linked clones.
+    """
+    path = os.path.abspath(path)
+    return [parent for parent in parent_disks(path) if os.path.dirname(parent) != path]
+
+
+def disk_size(disk):
+    base = disk[:-len('.vmdk')]
+    directory = os.path.dirname(disk)
+    return sum(os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory)
+               if os.path.join(directory, filename) == disk or (os.path.join(directory, filename).startswith(base + '-') and EXTENT_RE.search(filename)))
+
+
+def compact(path):
+    """
+    Defragments and shrinks the virtual disks in path. Returns the bytes
+    they took before and after, or None if vmware-vdiskmanager isn't
+    installed.
+    """
+    executable = vdiskmanager()
+    if not executable:
+        return None
+    before = after = 0
+    for disk in disks(path):
+        before += disk_size(disk)
+        if parent_disk(disk):
+            # Delta disks (of snapshots or linked clones) can't be shrunk
+            logger.warning("Cannot compact %s, it's a delta disk", os.path.basename(disk))
+            after += disk_size(disk)
+            continue
+        for flag in ('-d', '-k'):
+            with trace.span('compact', disk=os.path.basename(disk), operation=flag):
+                returncode, stdoutdata, stderrdata = process.run([executable, flag, disk])
+            if returncode:
+                logger.warning("Cannot %s %s: %s", 'defragment' if flag == '-d' else 'shrink',
+                               os.path.basename(disk), (stderrdata or stdoutdata).strip())
+                break
+        after += disk_size(disk)
+    return before, after
+
+
+def compressor_cmds(compression, level=None, jobs=None):
+    """
+    Returns the command line of a multi-threaded compressor writing to
+    stdout, or None if none is installed.
+    """
+    level = level or DEFAULT_LEVELS[compression]
+    if compression == 'zstd':
+        executable = which('zstd')
+        return executable and [executable, '-q', '-c', '-T{}'.format(jobs or 0), '-{}'.format(level)]
+    executable = which('pigz')
+    if executable:
+        cmds = [executable, '-c', '-{}'.format(level)]
+        if jobs:
+            cmds.extend(('-p', str(jobs)))
+        return cmds
+
+
+class HashingWriter(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fp.write(data)
+
+    def flush(self):
+        self.fp.flush()
+
+
+def write_tar(fileobj, path, names, extra=None):
+    """
+    Writes a tar stream of the given names in path, and of the extra
+    {name: contents} files, to fileobj.
+    """
+    import tarfile
+    tar = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT)
+    for name in names:
+        tar.add(os.path.join(path, name), arcname=name, recursive=False)
+    for name, data in sorted((extra or {}).items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+    tar.close()
+
+
+def package(path, output, compression='gzip', level=None, jobs=None):
+    """
+    Streams the files of the VM in path (but those VMware writes while
+    running) as a tar archive through a multi-threaded compressor to
+    output, with a metadata.json for the provider if the VM has none.
+    Returns a dict with the files and their sizes, the bytes read, the size
+    and sha256 of the box and the seconds it took, or None if it failed.
+    """
+    from .transfer import is_excluded, walk
+    start = time.time()
+    files = {}
+    for filename in walk(path, path, EXCLUDE):
+        name = os.path.relpath(filename, path).replace(os.sep, '/')
+        if not is_excluded(name, EXCLUDE):
+            files[name] = os.path.getsize(filename)
+    names = sorted(files)
+    extra = {}
+    if 'metadata.json' not in files:
+        extra['metadata.json'] = json.dumps({'provider': PROVIDER}).encode('utf-8')
+        files['metadata.json'] = len(extra['metadata.json'])
+
+    cmds = compressor_cmds(compression, level=level, jobs=jobs)
+    if not cmds and compression != 'gzip':
+        logger.error("Cannot find %s, install it to use %s compression", compression, compression)
+        return None
+
+    tmp_output = output + '.tmp'
+    with trace.span('package', compression=compression, bytes=sum(files.values())) as record:
+        with open(tmp_output, 'wb') as fp:
+            writer = HashingWriter(fp)
+            if cmds:
+                logger.debug(" ".join(cmds))
+                proc = process.popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                errors = []
+
+                def feed():
+                    try:
+                        write_tar(proc.stdin, path, names, extra)
+                    except (IOError, OSError) as exc:
+                        errors.append(exc)
+                    finally:
+                        proc.stdin.close()
+                thread = threading.Thread(target=feed)
+                thread.daemon = True
+                thread.start()
+                for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+                    writer.write(chunk)
+                thread.join()
+                if proc.wait() or errors:
+                    logger.error("Cannot compress the box: %s", errors[0] if errors else "exit status {}".format(proc.returncode))
+                    os.unlink(tmp_output)
+                    return None
+            else:
+                logger.warning("Cannot find pigz, compressing with a single thread")
+                compressed = gzip.GzipFile(filename='', mode='wb', fileobj=writer, compresslevel=level or DEFAULT_LEVELS['gzip'])
+                write_tar(compressed, path, names, extra)
+                compressed.close()
+        if os.name == "nt" and os.path.exists(output):
+            os.unlink(output)
+        os.rename(tmp_output, output)
+        record['size'] = writer.size
+
+    return {
+        'files': files,
+        'bytes': sum(files.values()),
+        'size': writer.size,
+        'sha256': writer.sha256.hexdigest(),
+        'seconds': time.time() - start,
+    }
+
+
+def write_catalog(output, name, version, stats, compression):
+    """
+    Writes the box metadata next to it (output + '.json'): a catalog which
+    `mech init` and `mech box add` take, with the box checksum and sizes.
+    Returns its path.
+    """
+    catalog = {
+        'name': name,
+        'versions': [{
+            'version': version,
+            'providers': [{
+                'name': PROVIDER,
+                'url': 'file://' + os.path.abspath(output).replace(os.sep, '/'),
+                'checksum_type': 'sha256',
+                'checksum': stats['sha256'],
+                'size': stats['size'],
+                'compression': compression,
+                'files': stats['files'],
+            }],
+        }],
+    }
+    path = output + '.json'
+    with open(path, 'w') as fp:
+        json.dump(catalog, fp, sort_keys=True, indent=2, separators=(',', ': '))
+    return path
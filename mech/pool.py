@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import logging
+
+from clint.textui import colored, puts_err
+
+from . import utils
+from . import process
+from . import snapshots
+from .vmrun import VMrun
+
+logger = logging.getLogger(__name__)
+
+POOLS_DIR = os.path.join(utils.HOME, 'pools')
+
+# Snapshot of the template the pool members are linked clones of.
+BASE_SNAPSHOT = 'mech-pool-base'
+
+DEFAULT_SIZE = 2
+
+
+def pool_key(box, version):
+    return '{}@{}'.format(box, version) if version else box
+
+
+def pool_path(box, version):
+    return os.path.join(*filter(None, (POOLS_DIR, box, version)))
+
+
+def load_pool(box, version):
+    path = os.path.join(pool_path(box, version), 'pool.json')
+    if os.path.exists(path):
+        with open(path) as fp:
+            return json.load(fp)
+
+
+def save_pool(box, version, size, descriptor=None):
+    path = pool_path(box, version)
+    utils.makedirs(path)
+    with open(os.path.join(path, 'pool.json'), 'w') as fp:
+        json.dump({
+            'box': box,
+            'box_version': version,
+            'size': size,
+            'descriptor': descriptor,
+        }, fp, sort_keys=True, indent=2, separators=(',', ': '))
+
+
+def pool_lock(box, version):
+    from filelock import FileLock
+    return FileLock(os.path.join(pool_path(box, version), 'pool.lock'), timeout=0)
+
+
+def members(box, version):
+    key = pool_key(box, version)
+    return dict((k, v) for k, v in utils.instances().items() if v and v.get('pool') == key)
+
+
+def remove_member(member_path, vmx=None):
+    if vmx and os.path.exists(vmx):
+        vmrun = VMrun(vmx)
+        vmrun.stop(mode='hard', quiet=True)
+        vmrun.deleteVM(quiet=True)
+    shutil.rmtree(member_path, ignore_errors=True)
+
+
+def warm(box, version, template_vmx, member):
+    """
+    Creates a pool member as a linked clone of the template, boots it until
+    it has an IP address and leaves it suspended, ready to be resumed.
+    """
+    key = pool_key(box, version)
+    member_path = os.path.join(pool_path(box, version), member)
+    vmx = os.path.join(member_path, '.mech', member + '.vmx')
+    utils.makedirs(os.path.dirname(vmx))
+    utils.save_mechfile({
+        'name': member,
+        'box': box,
+        'box_version': version,
+    }, member_path)
+    utils.settle_instance(member, {
+        'path': member_path,
+        'pool': key,
+        'state': 'warming',
+    })
+
+    start = time.time()
+    template = VMrun(template_vmx)
+    if template.clone(vmx, 'linked', snap_name=BASE_SNAPSHOT, clone_name=member) is None:
+        remove_member(member_path)
+        return False
+    with open(vmx, 'a') as fp:
+        # Don't ask whether the VM was moved or copied when it's handed out
+        fp.write('uuid.action = "keep"' + os.linesep)
+
+    vmrun = VMrun(vmx)
+    if vmrun.start() is None or not vmrun.getGuestIPAddress(wait=True, quiet=True) or vmrun.suspend() is None:
+        remove_member(member_path, vmx)
+        return False
+
+    utils.settle_instance(member, {
+        'path': member_path,
+        'pool': key,
+        'state': 'ready',
+    }, force=True)
+    puts_err(colored.green("Pool member {} ready in {:.1f}s".format(member, time.time() - start)))
+    return True
+
+
+def fill(box, version, size=None, jobs=None, requests_kwargs={}, descriptor=None):
+    """
+    Brings the pool for the box up to its size. The box comes from the
+    descriptor (the Mechfile's url or file) or, if there's none, from the
+    one the pool was filled from before. Returns the number of members
+    created, or None if the pool is already being filled.
+    """
+    from filelock import Timeout
+    path = pool_path(box, version)
+    utils.makedirs(path)
+    pool = load_pool(box, version) or {}
+    if size is None:
+        size = pool.get('size', DEFAULT_SIZE)
+    descriptor = descriptor or pool.get('descriptor')
+    if descriptor and os.path.exists(descriptor):
+        descriptor = os.path.abspath(descriptor)
+    save_pool(box, version, size, descriptor=descriptor)
+
+    try:
+        with pool_lock(box, version):
+            template_vmx = utils.init_box(box, version, requests_kwargs=requests_kwargs, path=os.path.join(path, 'template'), descriptor=descriptor)
+            template = VMrun(template_vmx)
+            if BASE_SNAPSHOT not in snapshots.load(template, template_vmx):
+                if template.snapshot(BASE_SNAPSHOT) is None:
+                    puts_err(colored.red("Cannot take snapshot of the pool template"))
+                    return 0
+
+            missing = size - len(members(box, version))
+            if missing <= 0:
+                return 0
+            puts_err(colored.blue("Warming up {} machines for '{}'...".format(missing, pool_key(box, version))))
+            names = ['pool-{:08x}'.format(random.getrandbits(32)) for i in range(missing)]
+            results = utils.parallel(lambda member: warm(box, version, template_vmx, member), names, jobs)
+            return len([result for result in results if result is True])
+    except Timeout:
+        puts_err(colored.yellow("Pool for '{}' is already being filled".format(pool_key(box, version))))
+
+
+def replenish(box, version, descriptor=None):
+    """
+    Refills the pool in the background.
+    """
+    cmds = [sys.executable, '-m', 'mech', 'pool', 'fill']
+    if version:
+        cmds.extend(('--box-version', version))
+    if descriptor:
+        if os.path.exists(descriptor):
+            # The background process may not start in this directory
+            descriptor = os.path.abspath(descriptor)
+        cmds.extend(('--url', descriptor))
+    # Options go before the box name (commands parse options first)
+    cmds.append(box)
+    with open(os.devnull, 'w') as devnull:
+        process.popen(cmds, new_session=True, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=os.name != "nt")
+
+
+def adopt(box, version, path='.mech', descriptor=None):
+    """
+    Hands out a ready pool member for the box, moving its VM to path, and
+    refills the pool (from descriptor, if given). Returns the path to the
+    VMX or None if the pool has no ready members.
+    """
+    if not load_pool(box, version):
+        return None
+    claimed = utils.claim_instance(pool=pool_key(box, version), state='ready')
+    if not claimed:
+        replenish(box, version, descriptor)
+        return None
+    member, instance_data = claimed
+    member_path = instance_data['path']
+    utils.makedirs(path)
+    source = os.path.join(member_path, '.mech')
+    for filename in os.listdir(source):
+        shutil.move(os.path.join(source, filename), os.path.join(path, filename))
+    shutil.rmtree(member_path, ignore_errors=True)
+    replenish(box, version, descriptor)
+    return utils.get_vmx(path=path)
+
+
+def linked_instances(box, version):
+    """
+    Returns the names of the instances taken from the pool, whose disks are
+    still linked clones of the pool template.
+    """
+    from . import package
+    template_path = os.path.join(pool_path(box, version), 'template')
+    linked = []
+    for instance_name, instance_data in utils.instances().items():
+        if not instance_data or instance_data.get('pool') or not instance_data.get('path'):
+            continue
+        mech_path = os.path.join(instance_data['path'], '.mech', instance_data.get('machine') or '')
+        if os.path.isdir(mech_path) and any(parent.startswith(template_path + os.sep) for parent in package.linked_disks(mech_path)):
+            linked.append(instance_name)
+    return sorted(linked)
+
+
+def drain(box, version, template=False):
+    """
+    Deletes the idle members of the pool (and its template, if asked to).
+    While the pool is being filled, the members still warming up and the
+    template are left alone, as is the template while there are instances
+    linked to it.
+    """
+    from filelock import Timeout
+    path = pool_path(box, version)
+    utils.makedirs(path)
+    lock = pool_lock(box, version)
+    try:
+        lock.acquire()
+    except Timeout:
+        lock = None
+    try:
+        count = 0
+        for member, instance_data in members(box, version).items():
+            if not lock and instance_data.get('state') != 'ready':
+                continue
+            member_path = instance_data['path']
+            remove_member(member_path, utils.get_vmx(silent=True, path=os.path.join(member_path, '.mech')))
+            count += 1
+        if template and lock:
+            linked = linked_instances(box, version)
+            if linked:
+                puts_err(colored.yellow("Instances {} are linked clones of the pool template, not deleting it".format(", ".join(linked))))
+                template = False
+            else:
+                template_path = os.path.join(path, 'template')
+                remove_member(template_path, utils.get_vmx(silent=True, path=template_path))
+    finally:
+        if lock:
+            lock.release()
+    if template:
+        if lock:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            puts_err(colored.yellow("Pool for '{}' is being filled, not deleting its template".format(pool_key(box, version))))
+    return count
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import subprocess
+import collections
+
+from . import trace
+from .compat import b2s
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of bytes kept (per stream) from the output of a streamed
+# command, only the tail of the output is kept once this is exceeded.
+MAX_OUTPUT = 1024 * 1024
+
+
+def startupinfo():
+    if os.name == "nt":
+        info = subprocess.STARTUPINFO()
+        info.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
+        return info
+
+
+def popen(cmds, new_session=False, **kwargs):
+    """
+    Starts a process hiding its window on Windows. When new_session is set,
+    the process is placed in its own process group so the whole tree can
+    later be killed with kill_tree().
+    """
+    if new_session and os.name != "nt":
+        kwargs['preexec_fn'] = os.setsid
+    kwargs['env'] = trace.child_env(kwargs.get('env'))
+    return subprocess.Popen(cmds, startupinfo=startupinfo(), **kwargs)
+
+
+def kill_tree(proc):
+    """
+    Kills a process and all of its children (those in its process group,
+    when it was started in a new session; otherwise the group is ours and
+    only the process itself is killed).
+    """
+    if proc.poll() is not None:
+        return
+    try:
+        if os.name == "nt":
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo())
+        else:
+            try:
+                pgid = os.getpgid(proc.pid)
+                if pgid == os.getpgrp():
+                    proc.kill()
+                else:
+                    os.killpg(pgid, signal.SIGKILL)
+            except OSError:
+                proc.kill()
+    except OSError:
+        pass
+
+
+class OutputBuffer(object):
+    """
+    Keeps the tail of an output stream, up to max_size bytes.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.lines = collections.deque()
+        self.size = 0
+        self.total = 0
+        self.truncated = False
+
+    def append(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        self.total += len(line)
+        if self.max_size is not None:
+            while self.size > self.max_size and len(self.lines) > 1:
+                self.size -= len(self.lines.popleft())
+                self.truncated = True
+
+    def getvalue(self):
+        return ''.join(self.lines)
+
+
+def line_printer(prefix=None, timestamps=True):
+    """
+    Returns a callback which forwards output lines to stdout/stderr
+    as they are produced, each line prefixed with a timestamp and
+    the given step prefix.
+    """
+    lock = threading.Lock()
+
+    def printer(line, is_err=False):
+        head = []
+        if timestamps:
+            head.append(time.strftime('[%H:%M:%S]'))
+        if prefix:
+            head.append(prefix)
+        if head:
+            line = "{} | {}".format(" ".join(head), line)
+        out = sys.stderr if is_err else sys.stdout
+        with lock:
+            out.write(line + '\n')
+            out.flush()
+    return printer
+
+
+def _reader(pipe, buf, callback, is_err):
+    try:
+        for line in iter(pipe.readline, b''):
+            line = b2s(line)
+            buf.append(line)
+            if callback:
+                callback(line.rstrip('\r\n'), is_err)
+    finally:
+        pipe.close()
+
+
+def run(cmds, stream=None, timeout=None, max_output=None, stdin=None, cwd=None, env=None):
+    """
+    Runs a command and returns a (returncode, stdoutdata, stderrdata) tuple.
+
+    If stream is a callable, it's called as stream(line, is_err) for every
+    line of output as soon as it's produced, otherwise output is collected
+    and returned once the command finishes. Only the last max_output bytes
+    of each stream are kept. When timeout (in seconds) expires, the command
+    and all of its children are killed.
+    """
+    with trace.span('process', program=os.path.basename(cmds[0])) as record:
+        returncode, stdout, stderr, timed_out = _run(cmds, stream, timeout, max_output, stdin, cwd, env)
+        record.update({
+            'returncode': returncode,
+            'stdout_bytes': stdout.total,
+            'stderr_bytes': stderr.total,
+        })
+        if timed_out:
+            record['timed_out'] = True
+
+    if timed_out:
+        logger.error("Command timed out after %s seconds", timeout)
+    for name, buf in (('stdout', stdout), ('stderr', stderr)):
+        if buf.truncated:
+            logger.debug("%s truncated, kept the last %s of %s bytes", name, buf.size, buf.total)
+
+    return returncode, stdout.getvalue(), stderr.getvalue()
+
+
+def _run(cmds, stream, timeout, max_output, stdin, cwd, env):
+    proc = popen(cmds, new_session=timeout is not None, stdin=stdin,
+                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, env=env)
+
+    stdout = OutputBuffer(max_output)
+    stderr = OutputBuffer(max_output)
+    readers = [
+        threading.Thread(target=_reader, args=(proc.stdout, stdout, stream, False)),
+        threading.Thread(target=_reader, args=(proc.stderr, stderr, stream, True)),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    timed_out = []
+    timer = None
+    if timeout is not None:
+        def expire():
+            timed_out.append(True)
+            kill_tree(proc)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        for reader in readers:
+            # Join with a timeout so KeyboardInterrupt gets delivered:
+            while reader.is_alive():
+                reader.join(0.1)
+        returncode = proc.wait()
+    except BaseException:
+        kill_tree(proc)
+        raise
+    finally:
+        if timer:
+            timer.cancel()
+
+    return returncode, stdout, stderr, bool(timed_out)
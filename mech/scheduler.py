@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import division, absolute_import
+
+import os
+import re
+import sys
+import json
+import time
+import errno
+import random
+import logging
+import contextlib
+import subprocess
+
+from . import utils
+from .vmx import VMX, is_running
+from .compat import b2s
+
+logger = logging.getLogger(__name__)
+
+# VMware's defaults, used for VMs whose VMX doesn't exist yet or doesn't say
+DEFAULT_MEMSIZE = 256
+DEFAULT_NUMVCPUS = 1
+
+# Memory (in MB) left free for the host while starting VMs
+MEMORY_HEADROOM = 512
+
+# Seconds between checks of the host's available memory while waiting
+POLL_INTERVAL = 1.0
+
+# Starts in progress (by any mech process) and the resources they reserve
+STARTING_PATH = os.path.join(utils.DATA_DIR, 'starting')
+
+# Seconds after which the reservation of a start is dropped
+RESERVATION_TIMEOUT = 600
+
+# Seconds the CPUs allocated to an instance are kept for it while it's
+# not running (e.g. still booting)
+ALLOCATION_GRACE = 120
+
+
+def vm_resources(vmx, hardware=None):
+    """
+    Returns the (memsize in MB, numvcpus) configured in a VMX file, or in
+    the Mechfile's "hardware" (which `mech up` applies to the VMX).
+    """
+    memsize, numvcpus = DEFAULT_MEMSIZE, DEFAULT_NUMVCPUS
+    if vmx and os.path.exists(vmx):
+        vmx = VMX.load(vmx)
+        memsize = vmx.memsize or memsize
+        numvcpus = vmx.numvcpus or numvcpus
+    hardware = hardware or {}
+    return hardware.get('memory') or memsize, hardware.get('cpus') or numvcpus
+
+
+def host_cpus():
+    import multiprocessing  # slow to import, and only needed when starting VMs
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def host_available_memory():
+    """
+    Returns the memory (in MB) the host can give to new processes without
+    swapping, or None if it can't be told.
+    """
+    try:
+        if sys.platform.startswith('linux'):
+            meminfo = {}
+            with open('/proc/meminfo') as fp:
+                for line in fp:
+                    key, _, value = line.partition(':')
+                    meminfo[key] = int(value.split()[0])  # in kB
+            if 'MemAvailable' in meminfo:
+                return meminfo['MemAvailable'] // 1024
+            return (meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)) // 1024
+
+        if sys.platform == 'darwin':
+            output = b2s(subprocess.check_output(['vm_stat']))
+            page_size = int(re.search(r'page size of (\d+) bytes', output).group(1))
+            pages = 0
+            for key in ('Pages free', 'Pages inactive', 'Pages speculative', 'Pages purgeable'):
+                match = re.search(r'^{}:\s+(\d+)'.format(key), output, re.MULTILINE)
+                if match:
+                    pages += int(match.group(1))
+            return pages * page_size // (1024 * 1024)
+
+        if sys.platform == 'win32':
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [
+                    ('dwLength', ctypes.c_ulong),
+                    ('dwMemoryLoad', ctypes.c_ulong),
+                    ('ullTotalPhys', ctypes.c_ulonglong),
+                    ('ullAvailPhys', ctypes.c_ulonglong),
+                    ('ullTotalPageFile', ctypes.c_ulonglong),
+                    ('ullAvailPageFile', ctypes.c_ulonglong),
+                    ('ullTotalVirtual', ctypes.c_ulonglong),
+                    ('ullAvailVirtual', ctypes.c_ulonglong),
+                    ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+                ]
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.ullAvailPhys // (1024 * 1024)
+    except (IOError, OSError, ValueError, KeyError, AttributeError, subprocess.CalledProcessError) as exc:
+        logger.debug("Cannot read available memory: %r", exc)
+
+
+def instance_running(instance_data):
+    path = os.path.join(instance_data['path'], '.mech', instance_data['machine']) if instance_data.get('machine') else os.path.join(instance_data['path'], '.mech')
+    vmx = utils.get_vmx(silent=True, path=path)
+    return bool(vmx) and is_running(vmx)
+
+
+def pick_cpus(free, count):
+    """
+    Returns count of the free CPUs, consecutive ones (sharing caches) if
+    possible.
+    """
+    for i in range(len(free) - count + 1):
+        if free[i + count - 1] - free[i] == count - 1:
+            return free[i:i + count]
+    return free[:count]
+
+
+def allocate_cpus(instance_name, count, cpus=None):
+    """
+    Picks count host CPUs for an instance which aren't allocated to any
+    other instance in the index that is running (or was allocated them
+    recently), and records them in the index. The instance gets the same
+    CPUs it had if they're still free. CPU 0, which serves most of the
+    host's interrupts, is only given out when the others aren't enough.
+    Returns the CPUs or None if there aren't enough free ones.
+    """
+    cpus = cpus or host_cpus()
+    with utils.locked_index() as index:
+        instance_data = index.get(instance_name)
+        if not instance_data:
+            return None
+        now = time.time()
+        taken = set()
+        for name, data in index.items():
+            if name == instance_name or not data or not data.get('cpus'):
+                continue
+            if now - data.get('cpus_time', 0) < ALLOCATION_GRACE or instance_running(data):
+                taken.update(data['cpus'])
+        free = [cpu for cpu in range(cpus) if cpu not in taken]
+        previous = instance_data.get('cpus') or []
+        if len(previous) == count and all(cpu in free for cpu in previous):
+            allocated = previous
+        elif len(free) - (0 in free) >= count:
+            allocated = pick_cpus([cpu for cpu in free if cpu], count)
+        elif len(free) >= count:
+            allocated = pick_cpus(free, count)
+        else:
+            return None
+        instance_data['cpus'] = allocated
+        instance_data['cpus_time'] = now
+        return allocated
+
+
+def process_alive(pid):
+    if os.name == "nt":
+        # Windows has no signal 0, stale reservations expire instead
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+
+class Scheduler(object):
+    """
+    Admits VM starts, across mech processes, only while the host has room
+    for them: the vCPUs of the VMs being started must fit in the host's CPUs
+    and their memory in the host's available memory (sampled on every
+    decision, less a headroom). A VM holds its reservation from `vmrun
+    start` until it has an IP address. The memory the host stopped
+    reporting as available since the VMs being started were admitted is
+    already used by them, so only the rest of their memory is reserved. A
+    start is always admitted when no other one is in progress, so VMs
+    larger than the host still make progress.
+    """
+
+    def __init__(self, cpus=None, headroom=MEMORY_HEADROOM, path=STARTING_PATH):
+        self.cpus = cpus or host_cpus()
+        self.headroom = headroom
+        self.path = path
+
+    @contextlib.contextmanager
+    def reservations(self):
+        """
+        Yields the state of the starts in progress, {'reservations': {...},
+        'baseline': available memory when they began}, holding its lock,
+        and saves it back.
+        """
+        from filelock import FileLock
+        utils.makedirs(os.path.dirname(self.path))
+        with FileLock(self.path + '.lock', timeout=10):
+            try:
+                with open(self.path) as fp:
+                    state = json.load(fp)
+            except (IOError, OSError, ValueError):
+                state = {}
+            reservations = state.setdefault('reservations', {})
+            now = time.time()
+            for key, reservation in list(reservations.items()):
+                # Drop the reservations of mech processes which are gone
+                if now - reservation['time'] > RESERVATION_TIMEOUT or not process_alive(reservation['pid']):
+                    del reservations[key]
+            if not reservations:
+                state['baseline'] = None
+            yield state
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(state, fp, sort_keys=True, indent=2, separators=(',', ': '))
+            if os.name == "nt" and os.path.exists(self.path):
+                os.unlink(self.path)
+            os.rename(tmp_path, self.path)
+
+    def fits(self, state, memsize, numvcpus, available):
+        reservations = list(state['reservations'].values())
+        if not reservations:
+            return True
+        if sum(reservation['numvcpus'] for reservation in reservations) + numvcpus > self.cpus:
+            return False
+        if available is not None and state['baseline'] is not None:
+            reserved = sum(reservation['memsize'] for reservation in reservations)
+            used = max(0, state['baseline'] - available)
+            if available - max(0, reserved - used) - self.headroom < memsize:
+                return False
+        return True
+
+    @contextlib.contextmanager
+    def admit(self, memsize, numvcpus, waiting=None):
+        """
+        Blocks until a VM with the given resources can be started, calling
+        waiting() if it has to wait, and holds its resources while the
+        context lasts.
+        """
+        key = '{}-{:08x}'.format(os.getpid(), random.getrandbits(32))
+        waited = False
+        while True:
+            available = host_available_memory()
+            with self.reservations() as state:
+                if self.fits(state, memsize, numvcpus, available):
+                    if not state['reservations']:
+                        state['baseline'] = available
+                    state['reservations'][key] = {
+                        'memsize': memsize,
+                        'numvcpus': numvcpus,
+                        'pid': os.getpid(),
+                        'time': time.time(),
+                    }
+                    break
+            if waiting and not waited:
+                waiting()
+                waited = True
+            time.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            with self.reservations() as state:
+                if state['reservations'].pop(key, None) and state['baseline'] is not None:
+                    # The VM's memory now counts as used by the host
+                    state['baseline'] -= memsize
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import re
+import json
+import logging
+
+from .vmx import VMX, is_running
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot(object):
+    def __init__(self, uid, name, parent=None, created=None, description=None):
+        self.uid = uid
+        self.name = name
+        self.parent = parent
+        self.created = created
+        self.description = description
+        self.children = []
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'created': self.created,
+            'description': self.description,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+class SnapshotTree(object):
+    """
+    Tree of the snapshots of a VM, built either from the VM's .vmsd file or
+    from the output of `vmrun listSnapshots showTree`.
+    """
+
+    def __init__(self, snapshots=(), current=None):
+        self.snapshots = list(snapshots)
+        self.current = current
+        self.by_uid = dict((snapshot.uid, snapshot) for snapshot in self.snapshots)
+        self.roots = []
+        for snapshot in self.snapshots:
+            parent = self.by_uid.get(snapshot.parent)
+            if parent:
+                parent.children.append(snapshot)
+            else:
+                self.roots.append(snapshot)
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __iter__(self):
+        return iter(self.snapshots)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get(self, name):
+        for snapshot in self.snapshots:
+            if snapshot.name == name:
+                return snapshot
+
+    def children(self, name):
+        snapshot = self.get(name)
+        return [child.name for child in snapshot.children] if snapshot else []
+
+    def names(self):
+        return [snapshot.name for snapshot in self.snapshots]
+
+    def tree(self, indent='  '):
+        lines = []
+
+        def walk(snapshots, depth):
+            for snapshot in snapshots:
+                lines.append(indent * depth + snapshot.name)
+                walk(snapshot.children, depth + 1)
+        walk(self.roots, 0)
+        return os.linesep.join(lines)
+
+    def to_list(self):
+        return [snapshot.to_dict() for snapshot in self.roots]
+
+    def to_cache(self):
+        return {
+            'current': self.current,
+            'snapshots': [{
+                'uid': snapshot.uid,
+                'name': snapshot.name,
+                'parent': snapshot.parent,
+                'created': snapshot.created,
+                'description': snapshot.description,
+            } for snapshot in self.snapshots],
+        }
+
+    @classmethod
+    def from_cache(cls, data):
+        return cls([Snapshot(**snapshot) for snapshot in data['snapshots']], current=data.get('current'))
+
+    @classmethod
+    def from_vmsd(cls, path):
+        # A .vmsd has the syntax (and |XX escapes) of a VMX
+        vmsd = VMX.load(path)
+        numbers = []
+        for key in vmsd:
+            match = re.match(r'^snapshot(\d+)\.uid$', key, re.IGNORECASE)
+            if match:
+                numbers.append(int(match.group(1)))
+
+        snapshots = []
+        for number in sorted(numbers):
+            prefix = 'snapshot{}.'.format(number)
+            created = None
+            high = vmsd.get_int(prefix + 'createTimeHigh')
+            if high is not None:
+                # Microseconds since the epoch, split in two 32 bit integers
+                low = vmsd.get_int(prefix + 'createTimeLow', 0) & 0xffffffff
+                created = ((high << 32) | low) // 1000000
+            snapshots.append(Snapshot(
+                uid=vmsd.get(prefix + 'uid'),
+                name=vmsd.get(prefix + 'displayName', ''),
+                parent=vmsd.get(prefix + 'parent'),
+                created=created,
+                description=vmsd.get(prefix + 'description') or None,
+            ))
+        return cls(snapshots, current=vmsd.get('snapshot.current'))
+
+    @classmethod
+    def from_show_tree(cls, output):
+        snapshots = []
+        parents = []
+        for line in (output or '').splitlines():
+            if not line.strip() or line.startswith('Total snapshots'):
+                continue
+            depth = len(line) - len(line.lstrip('\t'))
+            del parents[depth:]
+            uid = str(len(snapshots) + 1)
+            snapshots.append(Snapshot(uid=uid, name=line.strip(), parent=parents[-1] if parents else None))
+            parents.append(uid)
+        return cls(snapshots)
+
+
+def get_vmsd(vmx):
+    return os.path.splitext(vmx)[0] + '.vmsd'
+
+
+def load(vmrun, vmx, cache_path=None):
+    """
+    Returns the SnapshotTree of a VM. The .vmsd file is read directly when
+    the VM is off; otherwise `vmrun listSnapshots showTree` is used and its
+    result is cached in cache_path, keyed by the .vmsd file modification time.
+    """
+    vmsd = get_vmsd(vmx)
+    if not os.path.exists(vmsd):
+        return SnapshotTree()
+
+    if not is_running(vmx):
+        return SnapshotTree.from_vmsd(vmsd)
+
+    st = os.stat(vmsd)
+    key = [st.st_mtime, st.st_size]
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as fp:
+                cache = json.load(fp)
+            if cache.get('key') == key:
+                return SnapshotTree.from_cache(cache['tree'])
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    output = vmrun.listSnapshots(show_tree=True, quiet=True)
+    if output is None:
+        logger.debug("Cannot list snapshots, reading %s instead", vmsd)
+        return SnapshotTree.from_vmsd(vmsd)
+    tree = SnapshotTree.from_show_tree(output)
+    if cache_path:
+        with open(cache_path, 'w') as fp:
+            json.dump({'key': key, 'tree': tree.to_cache()}, fp, sort_keys=True, indent=2, separators=(',', ': '))
+    return tree
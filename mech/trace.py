@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import threading
+import itertools
+import contextlib
+
+TRACE_ENV = 'MECH_TRACE'
+PARENT_ENV = 'MECH_TRACE_PARENT'
+
+# Finished spans are appended as JSON lines to this file (given with
+# `--trace FILE` or in MECH_TRACE); spans nest per thread, and mech
+# processes started while tracing record the span that started them as
+# their parent.
+path = os.environ.get(TRACE_ENV) or None
+
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+def enable(trace_path):
+    global path
+    path = os.path.abspath(trace_path)
+    # So mech processes started from this one trace to the same file:
+    os.environ[TRACE_ENV] = path
+
+
+def current():
+    """
+    Returns the id of the innermost open span of this thread.
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else os.environ.get(PARENT_ENV)
+
+
+def inherit(span_id):
+    """
+    Makes span_id (usually current() in another thread) the parent of the
+    spans of this thread.
+    """
+    if path and span_id:
+        _local.stack = [span_id]
+
+
+def child_env(env=None):
+    """
+    Returns the environment for a child process so its spans are linked
+    to the current one, or env untouched when not tracing.
+    """
+    if not path:
+        return env
+    env = dict(os.environ if env is None else env)
+    env[TRACE_ENV] = path
+    parent = current()
+    if parent:
+        env[PARENT_ENV] = parent
+    return env
+
+
+def emit(record):
+    if not path:
+        return
+    line = json.dumps(record, sort_keys=True, default=str) + '\n'
+    with _lock:
+        with open(path, 'a') as fp:
+            fp.write(line)
+
+
+def record(name, start, parent=None, **attrs):
+    """
+    Emits a span started at start and ending now, for code which can't nest
+    span() blocks (coroutines interleave in the same thread).
+    """
+    if not path:
+        return
+    attrs.update({
+        'name': name,
+        'id': '{}.{}'.format(os.getpid(), next(_ids)),
+        'parent': parent,
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+        'start': start,
+        'duration': time.time() - start,
+    })
+    emit(attrs)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    Times the block and emits it as a span with the given attributes. The
+    yielded dict can be updated with results (exit status, byte counts...)
+    and is a throwaway when not tracing.
+    """
+    record = dict(attrs)
+    if not path:
+        yield record
+        return
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    span_id = '{}.{}'.format(os.getpid(), next(_ids))
+    parent = current()
+    start = time.time()
+    _local.stack.append(span_id)
+    try:
+        yield record
+    except SystemExit as exc:
+        if exc.code:
+            record['error'] = 'exit {}'.format(exc.code)
+        raise
+    except BaseException as exc:
+        record['error'] = '{}: {}'.format(type(exc).__name__, exc)
+        raise
+    finally:
+        _local.stack.pop()
+        record.update({
+            'name': name,
+            'id': span_id,
+            'parent': parent,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'start': start,
+            'duration': time.time() - start,
+        })
+        emit(record)
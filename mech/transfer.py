@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import division, absolute_import
+
+import os
+import time
+import fnmatch
+import hashlib
+import logging
+import tarfile
+import posixpath
+import threading
+import subprocess
+
+from . import process
+from .compat import quote
+
+logger = logging.getLogger(__name__)
+
+# Partially copied files at least this big are resumed instead of copied again.
+RESUME_MIN_SIZE = 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+# Files removed in the machine by each rm command when deleting
+DELETE_BATCH = 500
+
+MANIFEST_SCRIPT = """
+cd {base} 2>/dev/null || exit 0
+if stat -c %s . >/dev/null 2>&1; then
+    find {names} -type f -exec stat -c '%s %Y %n' {{}} + 2>/dev/null
+else
+    find {names} -type f -exec stat -f '%z %m %N' {{}} + 2>/dev/null
+fi
+exit 0
+"""
+
+CHECKSUM_SCRIPT = """
+cd {base} 2>/dev/null || exit 0
+if command -v sha1sum >/dev/null 2>&1; then
+    find {names} -type f -exec sha1sum {{}} + 2>/dev/null
+else
+    find {names} -type f -exec shasum {{}} + 2>/dev/null
+fi
+exit 0
+"""
+
+PREFIX_CHECKSUM_SCRIPT = """
+if command -v sha1sum >/dev/null 2>&1; then
+    head -c {size} {path} | sha1sum
+else
+    head -c {size} {path} | shasum
+fi
+"""
+
+
+def normalize(name):
+    name = name.replace('\\', '/')
+    while name.startswith('./'):
+        name = name[2:]
+    return name
+
+
+def is_safe(name):
+    return not name.startswith('/') and '..' not in name.split('/')
+
+
+def sha1(path, size=None):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while size is None or size > 0:
+            chunk = fp.read(CHUNK_SIZE if size is None else min(size, CHUNK_SIZE))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if size is not None:
+                size -= len(chunk)
+    return digest.hexdigest()
+
+
+def is_excluded(name, exclude):
+    """
+    Tells if a (normalized) name, or any of its parent directories, matches
+    one of the glob patterns in exclude.
+    """
+    parts = name.split('/')
+    for pattern in exclude:
+        if fnmatch.fnmatch(name, pattern) or any(fnmatch.fnmatch(part, pattern) for part in parts):
+            return True
+    return False
+
+
+def walk(top, base, exclude):
+    for root, dirnames, filenames in os.walk(top):
+        if exclude:
+            dirnames[:] = [d for d in dirnames if not is_excluded(normalize(os.path.relpath(os.path.join(root, d), base)), exclude)]
+        for filename in filenames:
+            yield os.path.join(root, filename)
+
+
+def local_manifest(base, names=None, checksum=False, exclude=()):
+    """
+    Returns a {name: (size, mtime, sha1)} dictionary of the files in base
+    (or only those under names) but those matching exclude, sha1 is None
+    unless checksum is set.
+    """
+    manifest = {}
+    for name in names or ['.']:
+        top = os.path.join(base, name)
+        if os.path.isfile(top):
+            paths = [top]
+        else:
+            paths = walk(top, base, exclude)
+        for path in paths:
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            if exclude and is_excluded(normalize(os.path.relpath(path, base)), exclude):
+                continue
+            st = os.stat(path)
+            manifest[normalize(os.path.relpath(path, base))] = (st.st_size, int(st.st_mtime), sha1(path) if checksum else None)
+    return manifest
+
+
+class CountingReader(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.count += len(data)
+        return data
+
+
+class Transfer(object):
+    """
+    Copies files to and from a machine streaming a tar archive over a single
+    SSH channel. In delta mode, files whose size and mtime (or checksum) are
+    already the same at the destination are skipped; with resume, partial
+    copies of big files at the destination are completed instead of sent
+    again. Local files matching the glob patterns in exclude are ignored.
+    """
+
+    def __init__(self, config_ssh_file, host, compress=False, delta=False, checksum=False, resume=False, exclude=()):
+        self.config_ssh_file = config_ssh_file
+        self.host = host
+        self.compress = compress
+        self.delta = delta or checksum
+        self.checksum = checksum
+        self.resume = resume
+        self.exclude = exclude
+        self.stats = {
+            'files': 0,
+            'bytes': 0,
+            'skipped': 0,
+            'resumed': 0,
+            'deleted': 0,
+            'seconds': 0.0,
+        }
+
+    def ssh_cmds(self, command):
+        cmds = ['ssh', '-F', self.config_ssh_file]
+        if self.compress:
+            cmds.extend(('-o', 'Compression=yes'))
+        cmds.extend((self.host, '--', command))
+        return cmds
+
+    def remote(self, command):
+        cmds = self.ssh_cmds(command)
+        logger.debug(" ".join(cmds))
+        returncode, stdoutdata, stderrdata = process.run(cmds)
+        if returncode:
+            logger.error(stderrdata.strip() or "Remote command failed ({})".format(returncode))
+            return None
+        return stdoutdata
+
+    def remote_manifest(self, base, names=None):
+        names = " ".join(quote('./' + name) for name in names) if names else '.'
+        output = self.remote(MANIFEST_SCRIPT.format(base=quote(base), names=names))
+        if output is None:
+            return None
+        manifest = {}
+        for line in output.splitlines():
+            line = line.split(' ', 2)
+            if len(line) == 3:
+                manifest[normalize(line[2])] = (int(line[0]), int(float(line[1])), None)
+        if self.checksum and manifest:
+            output = self.remote(CHECKSUM_SCRIPT.format(base=quote(base), names=names))
+            if output is None:
+                return None
+            for line in output.splitlines():
+                line = line.split(None, 1)
+                if len(line) == 2:
+                    name = normalize(line[1])
+                    if name in manifest:
+                        manifest[name] = manifest[name][:2] + (line[0],)
+        return manifest
+
+    def remote_prefix_sha1(self, path, size):
+        output = self.remote(PREFIX_CHECKSUM_SCRIPT.format(path=quote(path), size=size))
+        return output.split()[0] if output else None
+
+    def plan(self, source, destination, source_path, destination_path, local_is_source):
+        """
+        Compares the source and destination manifests, returns the names to
+        send and the (name, offset) of the files to resume.
+        """
+        send = []
+        resume = []
+        for name, (size, mtime, digest) in sorted(source.items()):
+            other = destination.get(name)
+            if other:
+                other_size, other_mtime, other_digest = other
+                if self.delta and size == other_size and (digest == other_digest if self.checksum else mtime == other_mtime):
+                    self.stats['skipped'] += 1
+                    continue
+                if self.resume and size >= RESUME_MIN_SIZE and 0 < other_size < size:
+                    if local_is_source:
+                        local_digest = sha1(source_path(name), other_size)
+                        remote_digest = self.remote_prefix_sha1(destination_path(name), other_size)
+                    else:
+                        local_digest = sha1(destination_path(name), other_size)
+                        remote_digest = self.remote_prefix_sha1(source_path(name), other_size)
+                    if local_digest == remote_digest:
+                        resume.append((name, other_size))
+                        continue
+            send.append(name)
+        return send, resume
+
+    def upload(self, src, dst, names=None, delete=False):
+        """
+        Copies a local file or directory (its contents, or only the given
+        names in it) to dst in the machine. With delete, files in dst which
+        are missing in the directory (and aren't excluded) are removed.
+        """
+        start = time.time()
+        src = os.path.abspath(src)
+        if os.path.isdir(src):
+            base, rename, remote_base = src, None, dst
+        else:
+            base, names = os.path.dirname(src), [os.path.basename(src)]
+            if dst.endswith('/'):
+                remote_base, rename = dst, None
+            else:
+                remote_base, rename = posixpath.dirname(dst) or '.', posixpath.basename(dst)
+
+        source = local_manifest(base, names, checksum=self.checksum, exclude=self.exclude)
+        local_names = dict((name, name) for name in source)
+        if rename:
+            source = dict((rename, entry) for entry in source.values())
+            local_names = {rename: names[0]}
+
+        delete = delete and not rename and not names
+        if self.delta or self.resume or delete:
+            destination = self.remote_manifest(remote_base, list(source) if rename or names else None)
+            if destination is None:
+                return None
+        else:
+            destination = {}
+
+        send, resume = self.plan(
+            source, destination,
+            lambda name: os.path.join(base, local_names[name]),
+            lambda name: posixpath.join(remote_base, name),
+            local_is_source=True,
+        )
+
+        if send:
+            cmds = self.ssh_cmds("mkdir -p {0} && tar -C {0} -xf -".format(quote(remote_base)))
+            logger.debug(" ".join(cmds))
+            proc = process.popen(cmds, stdin=subprocess.PIPE)
+            try:
+                tar = tarfile.open(fileobj=proc.stdin, mode='w|')
+                for name in send:
+                    path = os.path.join(base, local_names[name])
+                    tar.add(path, arcname=name, recursive=False)
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += source[name][0]
+                tar.close()
+            except IOError as exc:
+                logger.error("Cannot send files: %s", exc)
+            finally:
+                proc.stdin.close()
+            if proc.wait():
+                return None
+
+        for name, offset in resume:
+            path = os.path.join(base, local_names[name])
+            remote_path = posixpath.join(remote_base, name)
+            mtime = time.strftime('%Y%m%d%H%M.%S', time.gmtime(source[name][1]))
+            cmds = self.ssh_cmds("cat >> {0} && TZ=UTC touch -m -t {1} {0}".format(quote(remote_path), mtime))
+            logger.debug(" ".join(cmds))
+            proc = process.popen(cmds, stdin=subprocess.PIPE)
+            try:
+                with open(path, 'rb') as fp:
+                    fp.seek(offset)
+                    for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                        proc.stdin.write(chunk)
+                        self.stats['bytes'] += len(chunk)
+            finally:
+                proc.stdin.close()
+            if proc.wait():
+                return None
+            self.stats['resumed'] += 1
+
+        if delete:
+            deleted = sorted(name for name in destination if name not in source and not is_excluded(name, self.exclude))
+            for i in range(0, len(deleted), DELETE_BATCH):
+                command = "cd {} && rm -f -- {}".format(quote(remote_base), " ".join(quote(name) for name in deleted[i:i + DELETE_BATCH]))
+                if self.remote(command) is None:
+                    return None
+            self.stats['deleted'] += len(deleted)
+
+        self.stats['seconds'] = time.time() - start
+        return self.stats
+
+    def download(self, src, dst):
+        """
+        Copies a file or directory (its contents) in the machine to dst.
+        """
+        start = time.time()
+        kind = self.remote("test -d {0} && echo d || echo f".format(quote(src)))
+        if kind is None:
+            return None
+        if kind.strip() == 'd':
+            remote_base, names, rename, base = src, None, None, dst
+        else:
+            remote_base, names = posixpath.dirname(src) or '.', [posixpath.basename(src)]
+            if os.path.isdir(dst) or dst.endswith(os.sep) or dst.endswith('/'):
+                base, rename = dst, None
+            else:
+                base, rename = os.path.dirname(os.path.abspath(dst)), os.path.basename(dst)
+        base = os.path.abspath(base)
+
+        remote_names = None
+        if self.delta or self.resume:
+            source = self.remote_manifest(remote_base, names)
+            if source is None:
+                return None
+            remote_names = dict((name, name) for name in source)
+            if rename:
+                source = dict((rename, entry) for entry in source.values())
+                remote_names = {rename: names[0]}
+            destination = local_manifest(base, list(source), checksum=self.checksum) if source else {}
+            send, resume = self.plan(
+                source, destination,
+                lambda name: posixpath.join(remote_base, remote_names[name]),
+                lambda name: os.path.join(base, name),
+                local_is_source=False,
+            )
+            send = [remote_names[name] for name in send]
+        else:
+            send, resume = None, []
+
+        if send is None or send:
+            if send is None:
+                command = "tar -C {} -cf - {}".format(quote(remote_base), " ".join(quote(name) for name in names) if names else '.')
+            else:
+                command = "cd {} && tar -cf - -T -".format(quote(remote_base))
+            cmds = self.ssh_cmds(command)
+            logger.debug(" ".join(cmds))
+            proc = process.popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            def feed():
+                try:
+                    if send:
+                        proc.stdin.write("".join(name + "\n" for name in send).encode('utf-8'))
+                finally:
+                    proc.stdin.close()
+            feeder = threading.Thread(target=feed)
+            feeder.daemon = True
+            feeder.start()
+
+            reader = CountingReader(proc.stdout)
+            kwargs = {'filter': 'tar'} if hasattr(tarfile, 'data_filter') else {}
+            try:
+                tar = tarfile.open(fileobj=reader, mode='r|')
+                for member in tar:
+                    name = normalize(member.name)
+                    if name in ('', '.'):
+                        continue
+                    if not is_safe(name):
+                        logger.error("Skipping unsafe path '%s'", member.name)
+                        continue
+                    if rename and name == names[0]:
+                        name = rename
+                    member.name = name
+                    tar.extract(member, base, **kwargs)
+                    if member.isfile():
+                        self.stats['files'] += 1
+                tar.close()
+            except tarfile.TarError as exc:
+                logger.error("Cannot receive files: %s", exc)
+            finally:
+                proc.stdout.close()
+            feeder.join()
+            if proc.wait():
+                return None
+            self.stats['bytes'] += reader.count
+
+        for name, offset in resume:
+            path = os.path.join(base, name)
+            cmds = self.ssh_cmds("tail -c +{} {}".format(offset + 1, quote(posixpath.join(remote_base, remote_names[name]))))
+            logger.debug(" ".join(cmds))
+            proc = process.popen(cmds, stdout=subprocess.PIPE)
+            try:
+                with open(path, 'ab') as fp:
+                    for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+                        fp.write(chunk)
+                        self.stats['bytes'] += len(chunk)
+            finally:
+                proc.stdout.close()
+            if proc.wait():
+                return None
+            mtime = source[name][1]
+            os.utime(path, (mtime, mtime))
+            self.stats['resumed'] += 1
+
+        self.stats['seconds'] = time.time() - start
+        return self.stats
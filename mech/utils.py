@@ -28,20 +28,24 @@ import os
 import re
 import sys
 import json
-import tarfile
 import fnmatch
+import contextlib
 import logging
 import tempfile
-import textwrap
+import threading
 import subprocess
 import collections
 from shutil import copyfile
 
-import requests
-from filelock import Timeout, FileLock
+# requests, filelock and tarfile take a while to import, so they are
+# imported by the functions using them to keep every mech command fast.
+
 from clint.textui import colored, puts_err
 from clint.textui import progress
 
+from . import trace
+from . import process
+from .errors import MechError, IndexLocked, MechfileError, NotCreated, BoxError
 from .compat import raw_input, b2s
 
 logger = logging.getLogger(__name__)
@@ -50,6 +54,9 @@ logger = logging.getLogger(__name__)
 HOME = os.path.expanduser('~/.mech')
 DATA_DIR = os.path.join(HOME, 'data')
 
+# Boxes compressed with zstd can only be read by a system tar supporting it
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
 
 def makedirs(name, mode=0o777):
     try:
@@ -115,113 +122,206 @@ def locate(path, glob):
 
 
 def parse_vmx(path):
-    vmx = collections.OrderedDict()
-    with open(path) as fp:
-        for line in fp:
-            line = line.strip().split('=', 1)
-            if len(line) > 1:
-                vmx[line[0].rstrip()] = line[1].lstrip()
-    return vmx
+    from .vmx import VMX
+    vmx = VMX.load(path)
+    return collections.OrderedDict((key, vmx.get(key)) for key in vmx)
 
 
 def update_vmx(path):
-    updated = False
-
-    vmx = parse_vmx(path)
-
-    # Check if there is an existing interface
-    has_network = False
-    for vmx_key in vmx:
-        if vmx_key.startswith('ethernet'):
-            has_network = True
-
-    # Write one if there is not
-    if not has_network:
-        vmx["ethernet0.addresstype"] = "generated"
-        vmx["ethernet0.bsdname"] = "en0"
-        vmx["ethernet0.connectiontype"] = "nat"
-        vmx["ethernet0.displayname"] = "Ethernet"
-        vmx["ethernet0.linkstatepropagation.enable"] = "FALSE"
-        vmx["ethernet0.pcislotnumber"] = "32"
-        vmx["ethernet0.present"] = "TRUE"
-        vmx["ethernet0.virtualdev"] = "e1000"
-        vmx["ethernet0.wakeonpcktrcv"] = "FALSE"
+    from .vmx import VMX
+    vmx = VMX.load(path)
+
+    # Write a network interface if there is not one
+    if not vmx.has_network:
+        vmx.set("ethernet0.addresstype", "generated")
+        vmx.set("ethernet0.bsdname", "en0")
+        vmx.set("ethernet0.connectiontype", "nat")
+        vmx.set("ethernet0.displayname", "Ethernet")
+        vmx.set("ethernet0.linkstatepropagation.enable", False)
+        vmx.set("ethernet0.pcislotnumber", 32)
+        vmx.set("ethernet0.present", True)
+        vmx.set("ethernet0.virtualdev", "e1000")
+        vmx.set("ethernet0.wakeonpcktrcv", False)
         puts_err(colored.yellow("Added network interface to vmx file"))
-        updated = True
-
-    if updated:
-        with open(path, 'w') as new_vmx:
-            for key in vmx:
-                value = vmx[key]
-                row = "{} = {}".format(key, value)
-                new_vmx.write(row + os.linesep)
 
-    # puts_err(colored.yellow("Upgrading VM..."))
-    # vmrun = VMrun(path)
-    # vmrun.upgradevm()
+    vmx.save()
+
+
+def profile_names(profile=None):
+    """
+    Returns the names of the profiles in a Mechfile "profile" (a name or a
+    list of them), or in MECH_PROFILE (comma separated) if it has none.
+    """
+    if profile is None:
+        profile = os.environ.get('MECH_PROFILE', '').split(',')
+    elif not isinstance(profile, list):
+        profile = [profile]
+    return [name.strip() for name in profile if name and name.strip()]
+
+
+def apply_profile(path, profiles):
+    """
+    Applies profiles to the VMX of a powered off machine, but those which
+    were applied already. The "performance" profile upgrades the virtual
+    hardware and switches to paravirtual NICs and fewer devices, the
+    "density" one lets the host fit more machines in its memory.
+    """
+    from .vmx import VMX, PROFILES, PROFILE_KEY, profile_changes, is_running
+    from .vmrun import VMrun
+    for profile in profiles:
+        if profile not in PROFILES:
+            raise MechfileError("Unknown profile '{}' (use {})".format(profile, ", ".join(PROFILES)))
+    vmx = VMX.load(path)
+    applied = vmx.profiles
+    missing = [profile for profile in profiles if profile not in applied]
+    if not missing:
+        return False
+    if is_running(path) or vmx.suspended:
+        puts_err(colored.yellow("Cannot apply the {} profile to a running or suspended machine".format(", ".join(missing))))
+        return False
+
+    puts_err(colored.blue("Applying the {} profile...".format(", ".join(missing))))
+    with trace.span('profile', profile=",".join(missing)):
+        if 'performance' in missing:
+            # Fails for machines at the latest version already
+            VMrun(path).upgradevm(quiet=True)
+            vmx = VMX.load(path)
+        changed = []
+        for profile in missing:
+            changed.extend(profile_changes(vmx, profile))
+        vmx.set(PROFILE_KEY, ",".join(applied + missing))
+        vmx.save()
+    if changed:
+        puts_err(colored.yellow("Changed {} in vmx file".format(", ".join(changed))))
+    return True
 
 
-def instances():
+@contextlib.contextmanager
+def locked_index():
+    """
+    Yields the instance index (without the instances whose Mechfile is
+    gone) holding its lock; it's written back, atomically, if it changed.
+    """
+    from filelock import Timeout, FileLock
     makedirs(DATA_DIR)
     index_path = os.path.join(DATA_DIR, 'index')
-    index_lock = os.path.join(DATA_DIR, 'index.lock')
+    lock = FileLock(os.path.join(DATA_DIR, 'index.lock'), timeout=3)
     try:
-        with FileLock(index_lock, timeout=3):
-            updated = False
-            if os.path.exists(index_path):
-                with open(index_path) as fp:
-                    instances = json.loads(uncomment(fp.read()))
-                # prune unexistent Mechfiles
-                for k in list(instances):
-                    instance_data = instances[k]
-                    path = instance_data and instance_data.get('path')
-                    if not path or not os.path.exists(os.path.join(path, 'Mechfile')):
-                        del instances[k]
-                        updated = True
-            else:
-                instances = {}
-            if updated:
-                with open(index_path, 'w') as fp:
-                    json.dump(instances, fp, sort_keys=True, indent=2, separators=(',', ': '))
-            return instances
+        lock.acquire()
     except Timeout:
-        puts_err(colored.red(textwrap.fill("Couldn't access index, it seems locked.")))
-        sys.exit(1)
+        raise IndexLocked("Couldn't access index, it seems locked.")
+    try:
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as fp:
+                index = json.loads(uncomment(fp.read()))
+        saved = json.dumps(index, sort_keys=True)
+        # prune unexistent Mechfiles
+        for k in list(index):
+            instance_data = index[k]
+            path = instance_data and instance_data.get('path')
+            if not path or not os.path.exists(os.path.join(path, 'Mechfile')):
+                del index[k]
+        yield index
+        if json.dumps(index, sort_keys=True) != saved:
+            tmp_path = index_path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(index, fp, sort_keys=True, indent=2, separators=(',', ': '))
+            if os.name == "nt" and os.path.exists(index_path):
+                os.unlink(index_path)
+            os.rename(tmp_path, index_path)
+    finally:
+        lock.release()
+
+
+def instances():
+    with locked_index() as index:
+        return index
 
 
 def settle_instance(instance_name, obj=None, force=False):
-    makedirs(DATA_DIR)
-    index_path = os.path.join(DATA_DIR, 'index')
-    index_lock = os.path.join(DATA_DIR, 'index.lock')
-    try:
-        with FileLock(index_lock, timeout=3):
-            updated = False
-            if os.path.exists(index_path):
-                with open(index_path) as fp:
-                    instances = json.loads(uncomment(fp.read()))
-                # prune unexistent Mechfiles
-                for k in list(instances):
-                    instance_data = instances[k]
-                    path = instance_data and instance_data.get('path')
-                    if not path or not os.path.exists(os.path.join(path, 'Mechfile')):
-                        del instances[k]
-                        updated = True
+    with locked_index() as index:
+        instance_data = index.get(instance_name)
+        if not instance_data or force:
+            if obj:
+                instance_data = index[instance_name] = obj
             else:
-                instances = {}
-            instance_data = instances.get(instance_name)
-            if not instance_data or force:
-                if obj:
-                    instance_data = instances[instance_name] = obj
-                    updated = True
-                else:
-                    instance_data = {}
-            if updated:
-                with open(index_path, 'w') as fp:
-                    json.dump(instances, fp, sort_keys=True, indent=2, separators=(',', ': '))
-            return instance_data
-    except Timeout:
-        puts_err(colored.red(textwrap.fill("Couldn't access index, it seems locked.")))
-        sys.exit(1)
+                instance_data = {}
+        return instance_data
+
+
+def instance_names(index):
+    """
+    Returns the names of the instances in index but the warm pool members.
+    """
+    return sorted(k for k, v in index.items() if not (v or {}).get('pool'))
+
+
+def match_instances(patterns, names=None):
+    """
+    Returns the sorted names of the indexed instances (or of the given
+    names) matching any of the given names or glob patterns, and the
+    patterns which matched nothing.
+    """
+    names = sorted(instances() if names is None else names)
+    matched = []
+    unmatched = []
+    for pattern in patterns:
+        found = fnmatch.filter(names, pattern)
+        if not found:
+            unmatched.append(pattern)
+        for name in found:
+            if name not in matched:
+                matched.append(name)
+    return sorted(matched), unmatched
+
+
+def parallel(func, items, jobs=None):
+    """
+    Calls func(item) for every item using up to `jobs` threads and returns
+    the results in the same order as the items. Any exception raised by
+    func (including SystemExit) is returned in place of its result.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = collections.deque(enumerate(items))
+    lock = threading.Lock()
+    parent = trace.current()
+
+    def worker():
+        trace.inherit(parent)
+        while True:
+            with lock:
+                if not pending:
+                    return
+                i, item = pending.popleft()
+            try:
+                results[i] = func(item)
+            except BaseException as exc:
+                results[i] = exc
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max(1, jobs or len(items)), len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so KeyboardInterrupt gets delivered:
+        while thread.is_alive():
+            thread.join(0.1)
+    return results
+
+
+def claim_instance(**match):
+    """
+    Atomically takes out of the index the first instance whose data
+    matches all the given values, returns its (name, data) or None.
+    """
+    with locked_index() as index:
+        for instance_name in sorted(index):
+            instance_data = index[instance_name] or {}
+            if all(instance_data.get(k) == v for k, v in match.items()):
+                del index[instance_name]
+                return instance_name, instance_data
 
 
 def load_mechfile(pwd):
@@ -232,21 +332,46 @@ def load_mechfile(pwd):
                 try:
                     return json.loads(uncomment(fp.read()))
                 except ValueError:
-                    puts_err(colored.red("Invalid Mechfile." + os.linesep))
-                    break
+                    raise MechfileError("Invalid Mechfile in {}".format(pwd))
         new_pwd = os.path.basename(pwd)
         pwd = None if new_pwd == pwd else new_pwd
-    puts_err(colored.red(textwrap.fill(
+    raise MechfileError(
         "Couldn't find a Mechfile in the current directory any deeper directories. "
         "A Mech environment is required to run this command. Run `mech init` "
         "to create a new Mech environment. Or specify the name of the VM you'd "
         "like to start with `mech up <name>`. A final option is to change to a "
         "directory with a Mechfile and to try again."
-    )))
-    sys.exit(1)
+    )
+
+
+def machine_names(mechfile):
+    """
+    Returns the names of the machines in a multi-machine Mechfile, in
+    startup order (by their "group", then by name).
+    """
+    machines = mechfile.get('machines') or {}
+    return sorted(machines, key=lambda machine: ((machines[machine] or {}).get('group', 0), machine))
+
+
+def machine_mechfile(mechfile, machine):
+    """
+    Returns the settings of a machine in a multi-machine Mechfile: the
+    top level settings updated with the machine's own.
+    """
+    machines = mechfile.get('machines') or {}
+    if machine not in machines:
+        raise MechfileError("There is no machine '{}' in the Mechfile".format(machine))
+    merged = dict((k, v) for k, v in mechfile.items() if k != 'machines')
+    merged.update(machines[machine] or {})
+    return merged
+
+
+def machine_instance_name(name, machine):
+    return '{}.{}'.format(name, machine)
 
 
 def build_mechfile(descriptor, name=None, version=None, requests_kwargs={}):
+    import requests
     mechfile = {}
     if descriptor is None:
         return mechfile
@@ -284,11 +409,9 @@ def build_mechfile(descriptor, name=None, version=None, requests_kwargs={}):
             r.raise_for_status()
             catalog = r.json()
         except (requests.HTTPError, ValueError) as exc:
-            puts_err(colored.red("Bad response from HashiCorp's Vagrant Cloud API: %s" % exc))
-            sys.exit(1)
+            raise BoxError("Bad response from HashiCorp's Vagrant Cloud API: %s" % exc)
         except requests.ConnectionError:
-            puts_err(colored.red("Couldn't connect to HashiCorp's Vagrant Cloud API"))
-            sys.exit(1)
+            raise BoxError("Couldn't connect to HashiCorp's Vagrant Cloud API")
     return catalog_to_mechfile(catalog, name, version)
 
 
@@ -304,8 +427,7 @@ def catalog_to_mechfile(catalog, name=None, version=None):
                     mechfile['box_version'] = current_version
                     mechfile['url'] = provider['url']
                     return mechfile
-    puts_err(colored.red("Couldn't find a VMWare compatible VM for '{}'{}".format(name, " ({})".format(version) if version else "")))
-    sys.exit(1)
+    raise BoxError("Couldn't find a VMWare compatible VM for '{}'{}".format(name, " ({})".format(version) if version else ""))
 
 
 def tar_cmd(*args, **kwargs):
@@ -331,41 +453,55 @@ def tar_cmd(*args, **kwargs):
     return tar
 
 
-def init_box(name, version, force=False, save=True, requests_kwargs={}):
-    if not locate('.mech', '*.vmx'):
-        name_version_box = add_box(name, name=name, version=version, force=force, save=save, requests_kwargs=requests_kwargs)
+def open_box(box):
+    """
+    Opens a box with tarfile, for when there's no tar installed.
+    """
+    import tarfile
+    with open(box, 'rb') as fp:
+        if fp.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC:
+            raise BoxError("Box {} is compressed with zstd, which needs tar to be installed".format(os.path.basename(box)))
+    return tarfile.open(box, 'r')
+
+
+def init_box(name, version, force=False, save=True, requests_kwargs={}, path='.mech', descriptor=None, profile=None):
+    if not locate(path, '*.vmx'):
+        name_version_box = add_box(descriptor or name, name=name, version=version, force=force, save=save, requests_kwargs=requests_kwargs)
         if not name_version_box:
-            puts_err(colored.red("Cannot find a valid box with a VMX file in it"))
-            sys.exit(1)
+            raise BoxError("Cannot find a valid box with a VMX file in it")
         name, version, box = name_version_box
         # box = locate(os.path.join(*filter(None, (HOME, 'boxes', name, version))), '*.box')
 
         puts_err(colored.blue("Extracting box '{}'...".format(name)))
-        makedirs('.mech')
-        if sys.platform == 'win32':
-            cmd = tar_cmd('-xf', box, force_local=True)
-        else:
-            cmd = tar_cmd('-xf', box)
-        if cmd:
-            startupinfo = None
-            if os.name == "nt":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
-            proc = subprocess.Popen(cmd, cwd='.mech', startupinfo=startupinfo)
-            if proc.wait():
-                puts_err(colored.red("Cannot extract box"))
-                sys.exit(1)
-        else:
-            tar = tarfile.open(box, 'r')
-            tar.extractall('.mech')
+        with trace.span('extract', box=os.path.basename(box), bytes=os.path.getsize(box)):
+            makedirs(path)
+            if sys.platform == 'win32':
+                cmd = tar_cmd('-xf', box, force_local=True)
+            else:
+                cmd = tar_cmd('-xf', box)
+            if cmd:
+                startupinfo = None
+                if os.name == "nt":
+                    startupinfo = subprocess.STARTUPINFO()
+                    startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
+                proc = subprocess.Popen(cmd, cwd=path, startupinfo=startupinfo)
+                if proc.wait():
+                    raise BoxError("Cannot extract box")
+            else:
+                tar = open_box(box)
+                tar.extractall(path)
 
         if not save and box.startswith(tempfile.gettempdir()):
             os.unlink(box)
 
-    vmx = get_vmx()
+    vmx = get_vmx(path=path)
 
     update_vmx(vmx)
 
+    profiles = profile_names(profile)
+    if profiles:
+        apply_profile(vmx, profiles)
+
     return vmx
 
 
@@ -379,6 +515,9 @@ def add_mechfile(mechfile, name=None, version=None, force=False, save=True, requ
     file = mechfile.get('file')
     name = mechfile.get('box')
     version = mechfile.get('box_version')
+    if url and url.startswith('file:'):
+        # e.g. the catalogs written by `mech box repackage`
+        url, file = None, re.sub(r'^file:(?://)?', '', url)
     if file:
         return add_box_file(name, version, file, force=force, save=save)
     if url:
@@ -387,78 +526,86 @@ def add_mechfile(mechfile, name=None, version=None, force=False, save=True, requ
 
 
 def add_box_url(name, version, url, force=False, save=True, requests_kwargs={}):
+    from filelock import FileLock
+    import requests
     boxname = os.path.basename(url)
     box = os.path.join(*filter(None, (HOME, 'boxes', name, version, boxname)))
-    exists = os.path.exists(box)
-    if not exists or force:
-        if exists:
-            puts_err(colored.blue("Attempting to download box '{}'...".format(name)))
-        else:
-            puts_err(colored.blue("Box '{}' could not be found. Attempting to download...".format(name)))
-        try:
-            puts_err(colored.blue("URL: {}".format(url)))
-            r = requests.get(url, stream=True, **requests_kwargs)
-            r.raise_for_status()
-            try:
-                length = int(r.headers['content-length'])
-                progress_args = dict(expected_size=length // 1024 + 1)
-                progress_type = progress.bar
-            except KeyError:
-                progress_args = dict(every=1024 * 100)
-                progress_type = progress.dots
-            fp = tempfile.NamedTemporaryFile(delete=False)
+    makedirs(os.path.dirname(box))
+    # Machines brought up concurrently may need the same box:
+    with FileLock(box + '.lock'):
+        exists = os.path.exists(box)
+        if not exists or force:
+            if exists:
+                puts_err(colored.blue("Attempting to download box '{}'...".format(name)))
+            else:
+                puts_err(colored.blue("Box '{}' could not be found. Attempting to download...".format(name)))
             try:
-                for chunk in progress_type(r.iter_content(chunk_size=1024), label="{} ".format(boxname), **progress_args):
-                    if chunk:
-                        fp.write(chunk)
-                fp.close()
-                if r.headers.get('content-type') == 'application/json':
-                    # Downloaded URL might be a Vagrant catalog if it's json:
-                    catalog = json.load(fp.name)
-                    mechfile = catalog_to_mechfile(catalog, name, version)
-                    return add_mechfile(mechfile, name=name, version=version, force=force, save=save, requests_kwargs=requests_kwargs)
-                else:
-                    # Otherwise it must be a valid box:
-                    return add_box_file(name, version, fp.name, url=url, force=force, save=save)
-            finally:
-                os.unlink(fp.name)
-        except requests.HTTPError as exc:
-            puts_err(colored.red("Bad response: %s" % exc))
-            sys.exit(1)
-        except requests.ConnectionError:
-            puts_err(colored.red("Couldn't connect to '%s'" % url))
-            sys.exit(1)
-    return name, version, box
+                puts_err(colored.blue("URL: {}".format(url)))
+                with trace.span('http', method='GET', url=url) as record:
+                    r = requests.get(url, stream=True, **requests_kwargs)
+                    record['status'] = r.status_code
+                r.raise_for_status()
+                try:
+                    length = int(r.headers['content-length'])
+                    progress_args = dict(expected_size=length // 1024 + 1)
+                    progress_type = progress.bar
+                except KeyError:
+                    progress_args = dict(every=1024 * 100)
+                    progress_type = progress.dots
+                fp = tempfile.NamedTemporaryFile(delete=False)
+                try:
+                    with trace.span('download', url=url, bytes=0) as record:
+                        for chunk in progress_type(r.iter_content(chunk_size=1024), label="{} ".format(boxname), **progress_args):
+                            if chunk:
+                                fp.write(chunk)
+                                record['bytes'] += len(chunk)
+                        fp.close()
+                    if r.headers.get('content-type') == 'application/json':
+                        # Downloaded URL might be a Vagrant catalog if it's json:
+                        catalog = json.load(fp.name)
+                        mechfile = catalog_to_mechfile(catalog, name, version)
+                        return add_mechfile(mechfile, name=name, version=version, force=force, save=save, requests_kwargs=requests_kwargs)
+                    else:
+                        # Otherwise it must be a valid box:
+                        return add_box_file(name, version, fp.name, url=url, force=force, save=save)
+                finally:
+                    os.unlink(fp.name)
+            except requests.HTTPError as exc:
+                raise BoxError("Bad response: %s" % exc)
+            except requests.ConnectionError:
+                raise BoxError("Couldn't connect to '%s'" % url)
+        return name, version, box
 
 
 def add_box_file(name, version, filename, url=None, force=False, save=True):
     puts_err(colored.blue("Checking box '{}' integrity...".format(name)))
 
-    if sys.platform == 'win32':
-        cmd = tar_cmd('-tf', filename, '*.vmx', wildcards=True, fast_read=True, force_local=True)
-    else:
-        cmd = tar_cmd('-tf', filename, '*.vmx', wildcards=True, fast_read=True)
-    if cmd:
-        startupinfo = None
-        if os.name == "nt":
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
-        proc = subprocess.Popen(cmd, startupinfo=startupinfo)
-        valid_tar = not proc.wait()
-    else:
-        tar = tarfile.open(filename, 'r')
-        files = tar.getnames()
-        valid_tar = False
-        for i in files:
-            if i.endswith('vmx'):
-                valid_tar = True
-                break
-            if i.startswith('/') or i.startswith('..'):
-                puts_err(colored.red(textwrap.fill(
-                    "This box is comprised of filenames starting with '/' or '..' "
-                    "Exiting for the safety of your files."
-                )))
-                sys.exit(1)
+    with trace.span('validate', box=os.path.basename(filename), bytes=os.path.getsize(filename)) as record:
+        if sys.platform == 'win32':
+            cmd = tar_cmd('-tf', filename, '*.vmx', wildcards=True, fast_read=True, force_local=True)
+        else:
+            cmd = tar_cmd('-tf', filename, '*.vmx', wildcards=True, fast_read=True)
+        if cmd:
+            startupinfo = None
+            if os.name == "nt":
+                startupinfo = subprocess.STARTUPINFO()
+                startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
+            proc = subprocess.Popen(cmd, startupinfo=startupinfo)
+            valid_tar = not proc.wait()
+        else:
+            tar = open_box(filename)
+            files = tar.getnames()
+            valid_tar = False
+            for i in files:
+                if i.endswith('vmx'):
+                    valid_tar = True
+                    break
+                if i.startswith('/') or i.startswith('..'):
+                    raise BoxError(
+                        "This box is comprised of filenames starting with '/' or '..' "
+                        "Exiting for the safety of your files."
+                    )
+        record['valid'] = valid_tar
 
     if valid_tar:
         if save:
@@ -473,16 +620,16 @@ def add_box_file(name, version, filename, url=None, force=False, save=True):
         return name, version, box
 
 
-def index_active_instance(instance_name):
-    path = os.getcwd()
-    instance = settle_instance(instance_name, {
+def index_active_instance(instance_name, machine=None, path=None):
+    path = path or os.getcwd()
+    instance_data = {
         'path': path,
-    })
+    }
+    if machine:
+        instance_data['machine'] = machine
+    instance = settle_instance(instance_name, instance_data)
     if instance.get('path') != path:
-        puts_err(colored.red(textwrap.fill((
-            "There is already a Mech box with the name '{}' at {}"
-        ).format(instance_name, instance.get('path')))))
-        sys.exit(1)
+        raise MechError("There is already a Mech box with the name '{}' at {}".format(instance_name, instance.get('path')))
     return path
 
 
@@ -508,11 +655,26 @@ def get_requests_kwargs(arguments):
     return requests_kwargs
 
 
-def get_vmx(silent=False):
-    vmx = locate('.mech', '*.vmx')
+def command_options(arguments, exclude=()):
+    """
+    Rebuilds the command line options given to a command from its parsed
+    docopt arguments.
+    """
+    options = []
+    for key, value in sorted(arguments.items()):
+        if not key.startswith('-') or key in exclude or key in ('-h', '--help'):
+            continue
+        if value is True:
+            options.append(key)
+        elif value not in (None, False):
+            options.extend((key, value))
+    return options
+
+
+def get_vmx(silent=False, path='.mech'):
+    vmx = locate(path, '*.vmx')
     if not vmx and not silent:
-        puts_err(colored.red("Cannot locate a VMX file"))
-        sys.exit(1)
+        raise NotCreated("Cannot locate a VMX file")
     return vmx
 
 
@@ -520,7 +682,8 @@ def provision_file(vm, source, destination):
     return vm.copyFileFromHostToGuest(source, destination)
 
 
-def provision_shell(vm, inline, path, args=[]):
+def provision_shell(vm, inline, path, args=[], stream=None, timeout=None):
+    import requests
     tmp_path = vm.createTempfileInGuest()
     if tmp_path is None:
         return
@@ -537,7 +700,7 @@ def provision_shell(vm, inline, path, args=[]):
                     try:
                         r = requests.get(path)
                         r.raise_for_status()
-                        inline = r.read()
+                        inline = r.content
                     except requests.HTTPError:
                         return
                     except requests.ConnectionError:
@@ -551,6 +714,8 @@ def provision_shell(vm, inline, path, args=[]):
                 return
 
             puts_err(colored.blue("Configuring script..."))
+            if not isinstance(inline, bytes):
+                inline = inline.encode('utf-8')
             fp = tempfile.NamedTemporaryFile(delete=False)
             try:
                 fp.write(inline)
@@ -565,7 +730,7 @@ def provision_shell(vm, inline, path, args=[]):
             return
 
         puts_err(colored.blue("Executing program..."))
-        return vm.runProgramInGuest(tmp_path, args)
+        return vm.runProgramInGuest(tmp_path, args, stream=stream, timeout=timeout)
 
     finally:
         vm.deleteFileInGuest(tmp_path, quiet=True)
@@ -577,3 +742,69 @@ def config_ssh_string(config_ssh):
         if k != 'Host':
             ssh_config += "  {} {}".format(k, v) + os.linesep
     return ssh_config
+
+
+def instance_data_path(instance_name, *args):
+    path = os.path.join(DATA_DIR, instance_name)
+    makedirs(path)
+    return os.path.join(path, *args)
+
+
+def load_snapshot_stack(instance_name):
+    path = instance_data_path(instance_name, 'snapshots')
+    if os.path.exists(path):
+        with open(path) as fp:
+            return json.loads(uncomment(fp.read()))
+    return []
+
+
+def save_snapshot_stack(instance_name, stack):
+    path = instance_data_path(instance_name, 'snapshots')
+    if stack:
+        with open(path, 'w') as fp:
+            json.dump(stack, fp, sort_keys=True, indent=2, separators=(',', ': '))
+    elif os.path.exists(path):
+        os.unlink(path)
+
+
+def save_config_ssh(config_ssh, path):
+    """
+    Writes the ssh config file only if its contents changed, returns True
+    if the file was rewritten. The file is touched either way so its mtime
+    tells when it was last verified.
+    """
+    ssh_config = config_ssh_string(config_ssh)
+    try:
+        with open(path) as fp:
+            if fp.read() == ssh_config:
+                os.utime(path, None)
+                return False
+    except IOError:
+        pass
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.write(ssh_config)
+    if os.name == "nt" and os.path.exists(path):
+        os.unlink(path)
+    os.rename(tmp_path, path)
+    return True
+
+
+def config_ssh_host(path):
+    with open(path) as fp:
+        return fp.readline().split(None, 1)[1].strip()
+
+
+def ssh_master(config_path, host, operation='check'):
+    """
+    Sends a control command (check, exit) to the ssh master connection
+    of the given config, returns True if it succeeded.
+    """
+    if not os.path.exists(config_path):
+        return False
+    cmds = ['ssh', '-F', config_path, '-O', operation, host]
+    try:
+        returncode, stdoutdata, stderrdata = process.run(cmds)
+    except OSError:
+        return False
+    return returncode == 0
@@ -25,14 +25,23 @@ from __future__ import absolute_import
 
 import os
 import sys
+import json
 import logging
 import subprocess
 import tempfile
 
+from . import trace
+from . import process
 from .compat import PY3, b2s
 
 logger = logging.getLogger(__name__)
 
+# Telling the provider apart runs vmrun up to three times, so the one found
+# is remembered here (by executable and its modification time) across runs:
+PROVIDER_CACHE = os.path.join(os.path.expanduser('~'), '.mech', 'provider.json')
+
+_defaults = {}
+
 
 def get_fallback_executable():
     if 'PATH' in os.environ:
@@ -90,33 +99,114 @@ def get_provider(vmrun_exe):
                 startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
             proc = subprocess.Popen([vmrun_exe, '-T', provider, 'list'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo)
         except OSError:
-            pass
+            continue
 
         stdoutdata, stderrdata = map(b2s, proc.communicate())
         if proc.returncode == 0:
             return provider
 
 
-class VMrun(object):
-    if sys.platform == 'darwin':
-        default_executable = get_darwin_executable()
-    elif sys.platform == 'win32':
-        default_executable = get_win32_executable()
-    else:
-        default_executable = get_fallback_executable()
-    default_provider = get_provider(default_executable)
+def default_executable():
+    if 'executable' not in _defaults:
+        if sys.platform == 'darwin':
+            _defaults['executable'] = get_darwin_executable()
+        elif sys.platform == 'win32':
+            _defaults['executable'] = get_win32_executable()
+        else:
+            _defaults['executable'] = get_fallback_executable()
+    return _defaults['executable']
+
+
+def default_provider(executable):
+    """
+    Returns the provider for executable, probing it only the first time
+    (or after it changes).
+    """
+    if executable in _defaults:
+        return _defaults[executable]
+
+    try:
+        key = '{}:{}'.format(executable, os.path.getmtime(executable))
+    except (OSError, TypeError):
+        key = None
+    cache = {}
+    if key:
+        try:
+            with open(PROVIDER_CACHE) as fp:
+                cache = json.load(fp)
+        except (IOError, OSError, ValueError):
+            pass
+
+    provider = cache.get(key)
+    if not provider:
+        provider = get_provider(executable)
+        if key and provider:
+            cache = {key: provider}
+            try:
+                if not os.path.isdir(os.path.dirname(PROVIDER_CACHE)):
+                    os.makedirs(os.path.dirname(PROVIDER_CACHE))
+                with open(PROVIDER_CACHE, 'w') as fp:
+                    json.dump(cache, fp)
+            except (IOError, OSError):
+                pass
+    _defaults[executable] = provider
+    return provider
+
 
-    def __init__(self, vmx_file=None, user=None, password=None, executable=None, provider=None):
+class VMrun(object):
+    def __init__(self, vmx_file=None, user=None, password=None, executable=None, provider=None, timeout=None):
         self.vmx_file = vmx_file
         self.user = user
         self.password = password
-        self.executable = executable or self.default_executable
-        self.provider = provider or self.default_provider
-
-    def vmrun(self, cmd, *args, **kwargs):
-        quiet = kwargs.pop('quiet', False)
-        arguments = kwargs.pop('arguments', ())
-
+        self.timeout = timeout
+        self._executable = executable
+        self._provider = provider
+        # VMs using their own vmrun or provider always run it directly
+        self.direct = bool(executable or provider)
+
+    @property
+    def executable(self):
+        # Found the first time it's needed, so commands not running vmrun
+        # don't pay for it:
+        if not self._executable:
+            self._executable = default_executable()
+        return self._executable
+
+    @property
+    def provider(self):
+        if not self._provider:
+            self._provider = default_provider(self.executable)
+        return self._provider
+
+    def daemon_client(self):
+        if self.direct:
+            return None
+        from . import daemon
+        return daemon.client()
+
+    def daemon_vmrun(self, client, cmds, cmd, args, timeout):
+        from . import daemon
+        try:
+            result = client.call('vmrun', command=cmd, args=args, user=self.user, password=self.password,
+                                 timeout=timeout, cwd=os.getcwd())
+            return result['returncode'], result['stdout'], result['stderr']
+        except daemon.DaemonError as exc:
+            if cmd not in daemon.READ_ONLY:
+                # The daemon might have run it already, it can't be retried
+                return 1, '', str(exc)
+            logger.warning("%s, running vmrun directly", exc)
+            return process.run(cmds, timeout=timeout)
+
+    def changed(self, cmd):
+        """
+        Makes a running daemon drop the VM states it keeps after a command
+        which may have changed a VM ran without it.
+        """
+        from . import daemon
+        if cmd not in daemon.READ_ONLY:
+            daemon.invalidate()
+
+    def command_line(self, cmd, args):
         cmds = [self.executable]
         cmds.append('-T')
         cmds.append(self.provider)
@@ -127,23 +217,21 @@ class VMrun(object):
             cmds.append('-gp')
             cmds.append(self.password)
         cmds.append(cmd)
-        cmds.extend(filter(None, args))
-        cmds.extend(filter(None, arguments))
+        cmds.extend(args)
 
         logger.debug(" ".join("'{}'".format(c.replace("'", "\\'")) if ' ' in c else c for c in cmds))
+        return cmds
 
-        startupinfo = None
-        if os.name == "nt":
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
-        proc = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE, startupinfo=startupinfo)
-        stdoutdata, stderrdata = map(b2s, proc.communicate())
-
+    def result(self, returncode, stdoutdata, stderrdata, quiet=False):
+        """
+        Logs the outcome of a vmrun command, returns its output if it
+        succeeded or None otherwise.
+        """
         if stderrdata and not quiet:
             logger.error(stderrdata.strip())
-        logger.debug("(⏎ %s)" % proc.returncode)
+        logger.debug("(⏎ %s)" % returncode)
 
-        if not proc.returncode:
+        if not returncode:
             stdoutdata = stdoutdata.strip()
             logger.debug(repr(stdoutdata))
             return stdoutdata
@@ -151,6 +239,37 @@ class VMrun(object):
         if stdoutdata and not quiet:
             logger.error(stdoutdata.strip())
 
+    def vmrun(self, cmd, *args, **kwargs):
+        quiet = kwargs.pop('quiet', False)
+        arguments = kwargs.pop('arguments', ())
+        stream = kwargs.pop('stream', None)
+        timeout = kwargs.pop('timeout', None)
+        if timeout is None:
+            # Guest commands pass timeout=None when they have no timeout of their own
+            timeout = self.timeout
+
+        args = list(filter(None, args)) + list(filter(None, arguments))
+        cmds = self.command_line(cmd, args)
+
+        with trace.span('vmrun', command=cmd) as record:
+            client = None if stream else self.daemon_client()
+            if stream:
+                if not callable(stream):
+                    stream = process.line_printer(cmd if stream is True else stream)
+                returncode, stdoutdata, stderrdata = process.run(cmds, stream=stream, timeout=timeout, max_output=process.MAX_OUTPUT)
+                # Output was already forwarded as it was produced:
+                quiet = True
+            elif client:
+                record['daemon'] = True
+                returncode, stdoutdata, stderrdata = self.daemon_vmrun(client, cmds, cmd, args, timeout)
+            else:
+                returncode, stdoutdata, stderrdata = process.run(cmds, timeout=timeout)
+            record['returncode'] = returncode
+        if not client:
+            self.changed(cmd)
+
+        return self.result(returncode, stdoutdata, stderrdata, quiet=quiet)
+
     ############################################################################
     # POWER COMMANDS           PARAMETERS           DESCRIPTION
     # --------------           ----------           -----------
@@ -396,16 +515,17 @@ class VMrun(object):
     #                          [-wait]
     #
 
-    def runProgramInGuest(self, program_path, program_arguments=[], wait=True, activate_window=False, interactive=False, quiet=False):
-        return self.vmrun('runProgramInGuest', self.vmx_file, None if wait else '-noWait', '-activateWindow' if activate_window else None, '-interactive' if interactive else None, program_path, arguments=program_arguments, quiet=quiet)
+    def runProgramInGuest(self, program_path, program_arguments=[], wait=True, activate_window=False, interactive=False, quiet=False, stream=None, timeout=None):
+        '''Run a program in Guest OS'''
+        return self.vmrun('runProgramInGuest', self.vmx_file, None if wait else '-noWait', '-activateWindow' if activate_window else None, '-interactive' if interactive else None, program_path, arguments=program_arguments, quiet=quiet, stream=stream, timeout=timeout)
 
     def fileExistsInGuest(self, file, quiet=False):
         '''Check if a file exists in Guest OS'''
-        return 'not' not in self.execute('fileExistsInGuest', self.vmx_file, file)
+        return 'not' not in (self.vmrun('fileExistsInGuest', self.vmx_file, file, quiet=quiet) or 'not')
 
     def directoryExistsInGuest(self, path, quiet=False):
         '''Check if a directory exists in Guest OS'''
-        return 'not' not in self.execute('directoryExistsInGuest', self.vmx_file, path)
+        return 'not' not in (self.vmrun('directoryExistsInGuest', self.vmx_file, path, quiet=quiet) or 'not')
 
     def setSharedFolderState(self, share_name, new_path, mode='readonly', quiet=False):
         '''Modify a Host-Guest shared folder'''
@@ -434,9 +554,9 @@ class VMrun(object):
         '''Kill a process in Guest OS'''
         return self.vmrun('killProcessInGuest', self.vmx_file, pid, quiet=quiet)
 
-    def runScriptInGuest(self, interpreter_path, script, wait=True, activate_window=False, interactive=False, quiet=False):
+    def runScriptInGuest(self, interpreter_path, script, wait=True, activate_window=False, interactive=False, quiet=False, stream=None, timeout=None):
         '''Run a script in Guest OS'''
-        return self.vmrun('runScriptInGuest', self.vmx_file, interpreter_path, script, None if wait else '-noWait', '-activateWindow' if activate_window else None, '-interactive' if interactive else None, quiet=quiet)
+        return self.vmrun('runScriptInGuest', self.vmx_file, interpreter_path, script, None if wait else '-noWait', '-activateWindow' if activate_window else None, '-interactive' if interactive else None, quiet=quiet, stream=stream, timeout=timeout)
 
     def deleteFileInGuest(self, file, quiet=False):
         '''Delete a file in Guest OS'''
@@ -568,9 +688,9 @@ class VMrun(object):
         '''Delete a VM'''
         return self.vmrun('deleteVM', self.vmx_file, quiet=quiet)
 
-    def clone(self, dest_vmx, mode, snap_name=None, quiet=False):
+    def clone(self, dest_vmx, mode, snap_name=None, clone_name=None, quiet=False):
         '''Create a copy of the VM'''
-        return self.vmrun('clone', self.vmx_file, dest_vmx, mode, snap_name, quiet=quiet)
+        return self.vmrun('clone', self.vmx_file, dest_vmx, mode, '-snapshot={}'.format(snap_name) if snap_name else None, '-cloneName={}'.format(clone_name) if clone_name else None, quiet=quiet)
 
     ############################################################################
     # RECORD/REPLAY COMMANDS   PARAMETERS           DESCRIPTION
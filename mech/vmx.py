@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import io
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+LINE_RE = re.compile(r'^\s*([^#=\s][^=]*?)\s*=\s*(.*?)\s*$')
+
+DISK_CONTROLLERS = ('lsilogic', 'lsisas1068', 'pvscsi', 'buslogic')
+LATENCY_SENSITIVITIES = ('low', 'normal', 'medium', 'high')
+PRIORITIES = ('low', 'normal', 'high')
+
+# Mechfile "hardware" settings: (VMX keys, type or valid values)
+HARDWARE = {
+    'memory': (('memsize',), int),
+    'cpus': (('numvcpus',), int),
+    'cores_per_socket': (('cpuid.coresPerSocket',), int),
+    'disk_controller': (('scsi0.virtualDev',), DISK_CONTROLLERS),
+    'cpu_affinity': (('sched.cpu.affinity',), list),
+    'latency_sensitivity': (('sched.cpu.latencySensitivity',), LATENCY_SENSITIVITIES),
+    'priority': (('priority.grabbed', 'priority.ungrabbed'), PRIORITIES),
+}
+
+# The profiles applied to a VMX are recorded in it, so each is applied once
+PROFILE_KEY = 'mech.profile'
+PROFILES = ('performance', 'density')
+
+# Guests (by guestOS) whose stock kernels have vmxnet3 drivers. The boot
+# disk controller isn't switched to pvscsi, as installed guests may lack
+# its driver in their initramfs (hardware's disk_controller does it).
+VMXNET3_GUESTS = re.compile(r'^(ubuntu|debian|centos|rhel|oraclelinux|fedora|sles|opensuse|other[345]xlinux|freebsd1\d)', re.IGNORECASE)
+
+# Devices only slowing down the boot of a headless machine
+UNNEEDED_DEVICE_RE = re.compile(r'^(sound|floppy\d+|serial\d+|parallel\d+|usb|usb_xhci|ehci)\.present$', re.IGNORECASE)
+CDROM_RE = re.compile(r'^((?:ide|sata|scsi)\d+:\d+)\.deviceType$', re.IGNORECASE)
+
+
+def decode(value):
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+    # VMware escapes characters as |XX (hex)
+    return re.sub(r'\|([0-9A-Fa-f]{2})', lambda m: chr(int(m.group(1), 16)), value)
+
+
+def encode(value):
+    if isinstance(value, bool):
+        value = 'TRUE' if value else 'FALSE'
+    value = '{}'.format(value).replace('|', '|7C').replace('"', '|22')
+    return '"{}"'.format(value)
+
+
+class VMX(object):
+    """
+    A VMX file kept as its lines: setting a value rewrites only that line
+    (or appends one), so comments, order and the formatting of everything
+    else survive. Keys are case insensitive, as they are for VMware.
+    """
+
+    def __init__(self, path, text=''):
+        self.path = path
+        self.newline = '\r\n' if '\r\n' in text else '\n'
+        self.lines = text.splitlines()
+        self.index = {}
+        for i, line in enumerate(self.lines):
+            match = LINE_RE.match(line)
+            if match:
+                self.index[match.group(1).lower()] = i
+        self.changed = False
+
+    @classmethod
+    def load(cls, path):
+        with io.open(path, encoding='utf-8', errors='replace', newline='') as fp:
+            return cls(path, fp.read())
+
+    def __contains__(self, key):
+        return key.lower() in self.index
+
+    def __iter__(self):
+        for i in sorted(self.index.values()):
+            yield LINE_RE.match(self.lines[i]).group(1)
+
+    def get(self, key, default=None):
+        i = self.index.get(key.lower())
+        if i is None:
+            return default
+        return decode(LINE_RE.match(self.lines[i]).group(2))
+
+    def get_int(self, key, default=None):
+        try:
+            return int(self.get(key, ''))
+        except ValueError:
+            return default
+
+    def get_bool(self, key, default=None):
+        value = self.get(key, '').upper()
+        if value in ('TRUE', 'FALSE'):
+            return value == 'TRUE'
+        return default
+
+    def set(self, key, value):
+        """
+        Sets key to value, returns True if the value changed.
+        """
+        if self.get(key) == decode(encode(value)):
+            return False
+        i = self.index.get(key.lower())
+        if i is None:
+            self.index[key.lower()] = len(self.lines)
+            self.lines.append('{} = {}'.format(key, encode(value)))
+        else:
+            # Keep the key as it's spelled in the file
+            self.lines[i] = '{} = {}'.format(LINE_RE.match(self.lines[i]).group(1), encode(value))
+        self.changed = True
+        return True
+
+    def remove(self, key):
+        i = self.index.pop(key.lower(), None)
+        if i is None:
+            return False
+        del self.lines[i]
+        self.index = dict((k, j - 1 if j > i else j) for k, j in self.index.items())
+        self.changed = True
+        return True
+
+    def text(self):
+        return self.newline.join(self.lines) + self.newline
+
+    def save(self):
+        """
+        Writes the file (atomically) only if something changed, returns True
+        if it was written.
+        """
+        if not self.changed:
+            return False
+        tmp_path = self.path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8', newline='') as fp:
+            fp.write(self.text())
+        if os.name == "nt" and os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+        return True
+
+    @property
+    def memsize(self):
+        return self.get_int('memsize')
+
+    @property
+    def numvcpus(self):
+        return self.get_int('numvcpus')
+
+    @property
+    def cores_per_socket(self):
+        return self.get_int('cpuid.coresPerSocket')
+
+    @property
+    def disk_controller(self):
+        return self.get('scsi0.virtualDev')
+
+    @property
+    def cpu_affinity(self):
+        """
+        Returns the host CPUs the machine is pinned to, or None.
+        """
+        affinity = self.get('sched.cpu.affinity', 'all')
+        if affinity == 'all':
+            return None
+        try:
+            return [int(cpu) for cpu in affinity.split(',')]
+        except ValueError:
+            return None
+
+    @property
+    def suspended(self):
+        return bool(self.get('checkpoint.vmState'))
+
+    @property
+    def profiles(self):
+        return [name for name in self.get(PROFILE_KEY, '').split(',') if name]
+
+    @property
+    def has_network(self):
+        return any(key.lower().startswith('ethernet') for key in self)
+
+
+def performance_profile(vmx):
+    """
+    Switches the NICs of a VMX to paravirtual ones (vmxnet3) if its guest
+    has drivers for them and disables the sound card, floppy, USB, serial
+    and parallel ports and CD drives. Returns the changed keys.
+    """
+    guest = vmx.get('guestOS', '')
+    changed = []
+    for key in list(vmx):
+        if re.match(r'^ethernet\d+\.virtualDev$', key, re.IGNORECASE):
+            if VMXNET3_GUESTS.match(guest) and vmx.set(key, 'vmxnet3'):
+                changed.append(key)
+        elif UNNEEDED_DEVICE_RE.match(key):
+            if vmx.set(key, False):
+                changed.append(key)
+        else:
+            match = CDROM_RE.match(key)
+            if match and 'cdrom' in vmx.get(key).lower() and vmx.set(match.group(1) + '.present', False):
+                changed.append(match.group(1) + '.present')
+    # VMware adds a floppy drive unless told otherwise
+    if vmx.set('floppy0.present', False) and 'floppy0.present' not in changed:
+        changed.append('floppy0.present')
+    return changed
+
+
+def density_profile(vmx):
+    """
+    Lets the host pack more copies of the same machine by backing guest
+    memory with anonymous memory instead of a .vmem file (page sharing and
+    scaling memory down are already on by default). Returns the changed
+    keys.
+    """
+    settings = [
+        ('mainMem.useNamedFile', False),
+    ]
+    return [key for key, value in settings if vmx.set(key, value)]
+
+
+def profile_changes(vmx, name):
+    """
+    Applies the settings of a profile to vmx, returns the changed keys.
+    """
+    return {'performance': performance_profile, 'density': density_profile}[name](vmx)
+
+
+def is_running(path):
+    """
+    Tells whether VMware has the VMX open (it keeps a lock next to it).
+    """
+    return os.path.exists(path + '.lck')
+
+
+def hardware_settings(hardware):
+    """
+    Returns the VMX values for the "hardware" of a Mechfile (its "vmx"
+    values, set as they are, first), raising ValueError if they're invalid.
+    """
+    hardware = dict(hardware or {})
+    settings = dict(hardware.pop('vmx', None) or {})
+    for name, value in hardware.items():
+        if name not in HARDWARE:
+            raise ValueError("Unknown hardware setting '{}' (use {})".format(name, ", ".join(sorted(HARDWARE) + ['vmx'])))
+        keys, kind = HARDWARE[name]
+        if kind is int:
+            if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                raise ValueError("Hardware '{}' must be a positive integer".format(name))
+        elif kind is list:
+            if value == 'auto':
+                # Left for the caller to allocate
+                continue
+            if value != 'all':
+                if not isinstance(value, list) or not value or not all(isinstance(cpu, int) and not isinstance(cpu, bool) and cpu >= 0 for cpu in value):
+                    raise ValueError("Hardware '{}' must be \"auto\", \"all\" or a list of host CPU numbers".format(name))
+                if len(value) < hardware.get('cpus', 1):
+                    raise ValueError("Hardware '{}' must have at least as many CPUs as 'cpus'".format(name))
+                value = ",".join(str(cpu) for cpu in sorted(set(value)))
+        elif value not in kind:
+            raise ValueError("Unknown hardware '{}' value '{}' (use {})".format(name, value, ", ".join(kind)))
+        for key in keys:
+            settings[key] = value
+    if hardware.get('cpus') and hardware.get('cores_per_socket') and hardware['cpus'] % hardware['cores_per_socket']:
+        raise ValueError("Hardware 'cpus' must be a multiple of 'cores_per_socket'")
+    if hardware.get('memory', 4) % 4:
+        raise ValueError("Hardware 'memory' must be a multiple of 4 (MB)")
+    return settings
+
+
+def apply_hardware(path, hardware):
+    """
+    Applies the "hardware" of a Mechfile to the VMX file in path. The file
+    is only rewritten when a value changes, and never while the VM is
+    running or suspended (VMware would overwrite or refuse it). Returns
+    the changed keys.
+    """
+    settings = hardware_settings(hardware)
+    if not settings:
+        return []
+    vmx = VMX.load(path)
+    changed = [key for key, value in sorted(settings.items()) if vmx.set(key, value)]
+    if changed:
+        if is_running(path) or vmx.suspended:
+            logger.warning("Not changing %s while the machine is running or suspended", ", ".join(changed))
+            return []
+        vmx.save()
+    return changed
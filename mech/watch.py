@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2018 German Mendez Bravo (Kronuz)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+
+from .transfer import is_excluded, normalize
+
+logger = logging.getLogger(__name__)
+
+# Seconds without changes after which a burst of changes is synced
+DEBOUNCE = 0.2
+# ...but a burst is never held back for longer than this
+MAX_DELAY = 2.0
+# Seconds between scans of the polling watcher
+POLL_INTERVAL = 1.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT = struct.Struct('iIII')
+
+
+def walk_dirs(top, exclude):
+    for root, dirnames, filenames in os.walk(top):
+        dirnames[:] = [d for d in dirnames if not is_excluded(normalize(os.path.relpath(os.path.join(root, d), top)), exclude)]
+        yield root
+
+
+class PollingWatcher(object):
+    """
+    Finds changes by comparing the size and mtime of every file between
+    scans of the watched directories.
+    """
+
+    def __init__(self, paths, exclude=(), interval=POLL_INTERVAL):
+        self.paths = paths
+        self.exclude = exclude
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+        for path in self.paths:
+            if os.path.isfile(path):
+                filenames = [path]
+            else:
+                filenames = (os.path.join(root, filename) for root in walk_dirs(path, self.exclude) for filename in os.listdir(root))
+            for filename in filenames:
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                if not os.path.isdir(filename):
+                    state[filename] = (st.st_mtime, st.st_size)
+        return state
+
+    def poll(self, timeout):
+        """
+        Returns the paths which changed (or were deleted), waiting up to
+        timeout seconds for some to change.
+        """
+        deadline = time.time() + timeout
+        while True:
+            state = self.scan()
+            changed = set(path for path in set(state) | set(self.state) if state.get(path) != self.state.get(path))
+            self.state = state
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Gets changes from the kernel (Linux' inotify), watching every directory
+    under the watched paths. If a directory created later can't be watched
+    (e.g. when out of inotify watches), it falls back to polling.
+    """
+
+    def __init__(self, paths, exclude=()):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.paths = paths
+        self.exclude = exclude
+        self.watches = {}
+        self.fallback = None
+        try:
+            for path in paths:
+                self.add(path if os.path.isdir(path) else os.path.dirname(path))
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, top):
+        import ctypes
+        for directory in walk_dirs(top, self.exclude):
+            path = directory.encode(sys.getfilesystemencoding()) if not isinstance(directory, bytes) else directory
+            wd = self.libc.inotify_add_watch(self.fd, path, IN_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, "Cannot watch {} ({})".format(directory, os.strerror(error)))
+            self.watches[wd] = directory
+
+    def poll(self, timeout):
+        """
+        Returns the paths which changed (or were deleted), waiting up to
+        timeout seconds for some to change. A directory is returned when
+        everything under it must be considered changed.
+        """
+        if self.fallback:
+            return self.fallback.poll(timeout)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: everything could have changed
+                changed.update(set(self.watches.values()))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name.decode(sys.getfilesystemencoding()))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.add(path)
+                    try:
+                        if not self.fallback:
+                            self.add(path)
+                    except OSError as exc:
+                        logger.warning("Cannot use inotify (%s), polling for changes instead", exc)
+                        self.fallback = PollingWatcher(self.paths, exclude=self.exclude)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changed.add(path)
+            else:
+                changed.add(path)
+        if self.fallback and self.fd >= 0:
+            # Releases the watches, the polling watcher takes over
+            os.close(self.fd)
+            self.fd = -1
+        return changed
+
+    def close(self):
+        if self.fallback:
+            self.fallback.close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watcher(paths, exclude=(), poll=False):
+    """
+    Returns an inotify watcher for paths when possible, a polling one
+    otherwise.
+    """
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths, exclude=exclude)
+        except (OSError, AttributeError) as exc:
+            logger.warning("Cannot use inotify (%s), polling for changes instead", exc)
+    return PollingWatcher(paths, exclude=exclude)
+
+
+def changes(watcher, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+    """
+    Waits for something to change, then collects changes until none happen
+    for debounce seconds (or for max_delay seconds at most). Returns the
+    changed paths and the time the first change was noticed.
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.poll(1.0)
+    first = time.time()
+    while time.time() - first < max_delay:
+        more = watcher.poll(debounce)
+        if not more:
+            break
+        changed |= more
+    return changed, first
+
+
+def written(paths, noticed):
+    """
+    Returns when the earliest of paths was written (or when they were
+    noticed, if they're gone), the start of the changes' propagation.
+    Files moved in keep older mtimes, those can't be noticed that late.
+    """
+    start = noticed
+    for path in paths:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if noticed - POLL_INTERVAL <= mtime < start:
+            start = mtime
+    return start